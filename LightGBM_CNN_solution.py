@@ -1,177 +1,290 @@
 
 # Imports
+# The pipeline runs as a sequence of stages (see stages and main at the bottom, python LightGBM_CNN_solution.py --help). Only numpy and the
+# standard library are imported here, every stage imports its heavy dependencies (pandas, LightGBM, sklearn, keras, matplotlib) when it
+# runs, so importing this module or running the score command doesn't pay for them.
 import numpy as np
-import pandas as pd
-import lightgbm as lgb
 
-from sklearn.metrics import roc_auc_score, log_loss
-from sklearn.metrics import mean_squared_error
-from sklearn.model_selection import StratifiedKFold,KFold
-from scipy.stats import norm, skew
-
-from tqdm import tqdm_notebook as tqdm
 from copy import copy
 from multiprocessing import Pool
+import os
+import sys
+import json
+import shutil
+import argparse
 
 import warnings
 warnings.filterwarnings('ignore')
 np.random.seed(42)
+
+# Profiling
+# Every stage is timed and its peak RSS recorded (santander/profiling.py), the trees down to dataset build / train / predict / scoring per
+# variable and fold and the CNN per fold. The records are written as JSON to profile_path after every stage (None to switch it off). With
+# trace_allocations (--trace-allocations) the peak of the numpy/Python heap is recorded too, which slows the tree stage down noticeably.
+from santander import profiling
+
+profile_path = 'profile.json'
+trace_allocations = False
+profiler = profiling.Profiler(trace_allocations=trace_allocations)
+
 # Loading Data
 # At this point I filter out the fakes (shoutout to YaG320) and concatenate train and test for future FE. Setting use_experimental = True splits the Train data into train / test which was useful for later NN training indicating whether a model is overfitting. I wasn't sure if the fakes are going to be used for final score evaluation, so I also applied all the transformations to them and kept them in a separate dataframe.
 
 use_experimental = False
 
-train_df = pd.read_csv('../input/santander-customer-transaction-prediction/train.csv')
-test_df = pd.read_csv('../input/santander-customer-transaction-prediction/test.csv')
-
-indices_fake = np.load('../input/list-of-fake-samples-and-public-private-lb-split/synthetic_samples_indexes.npy')
-indices_pub = np.load('../input/list-of-fake-samples-and-public-private-lb-split/public_LB.npy')
-indices_pri = np.load('../input/list-of-fake-samples-and-public-private-lb-split/private_LB.npy')
-indices_real = np.concatenate([indices_pub, indices_pri])
-
-features = [c for c in train_df.columns if c not in ['ID_code', 'target']]
-target_train = train_df['target']
-X_train = train_df
-X_test = test_df.loc[indices_real,:]
-X_test['target'] = np.zeros(X_test.shape[0])
-X_fake = test_df.loc[indices_fake,:]
-X_fake['target'] = np.zeros(X_test.shape[0])
-train_length = X_train.shape[0]
-target_test = X_test['target']
-target_fake = X_fake['target']
-
-if use_experimental:
-    np.random.seed(42)    
-    indices = np.arange(train_length)
-    train_length = 150000
-    np.random.shuffle(indices)
-    indices_train = indices[:train_length]
-    indices_test = indices[train_length:]
-    # Swapped order to not overwrite X_train to soon
-    X_test = X_train.iloc[indices_test,:]
-    X_fake = X_train.iloc[indices_test,:]
-    target_fake = X_fake['target']
-    X_train = X_train.iloc[indices_train,:]
-    target_train = X_train['target']
-    target_test = X_test['target']
-
-X_all = pd.concat([X_train, X_test])
-print(X_all.shape)
+# The csv files are parsed once into a float32 memory-mapped cache (santander/data.py), reruns skip the parsing. X_train / X_test / X_fake
+# are row views on the cached tables, the rows are only gathered once into the feature store.
+from santander import data
+from santander.store import FeatureStore
+
+data_path = '../input/santander-customer-transaction-prediction/'
+indices_path = '../input/list-of-fake-samples-and-public-private-lb-split/'
+cache_path = 'cache'
+
+# Feature store
+# Instead of a growing X_all DataFrame (and the copies made by every concat / assignment / split) all features of train, test and fake live
+# in one preallocated float32 matrix (santander/store.py). Every stage below writes its family of features into it in place, train / test /
+# fake and X_all (= train + test) are row views. With store_dtype = np.float64 the count features are bit for bit the original ones.
+# Compact dtypes: the float32 store holds the counts exactly (they are integers far below 2**24), the frequency tables keep them as uint16 /
+# uint32, density / deviation are computed in float32, the scaler is applied in place in float32 and the tree outputs are stored in
+# float32. That halves memory and bandwidth of every stage after loading, python -m santander.benchmark --parity compares the AUCs against
+# a store_dtype = np.float64 run.
+store_dtype = np.float32
+
+# Out-of-core mode
+# For tables that don't fit into memory set store_path, the feature store is then a memory-mapped file in that directory (the raw data is
+# already a memory-mapped cache). Every stage works on row shards of shard_size rows or column by column: the frequency tables are counted
+# in a streaming pass over the shards, the scaler is fitted with partial_fit per shard, every tree only loads its own columns and the CNN
+# gets its batches gathered from the store (santander/batches.py) instead of 1000 column matrices.
+store_path = None
+shard_size = 1000000
+
+def load_data():
+    global train, test, indices_fake, indices_pub, indices_pri, indices_real, features, X_train, X_test, X_fake, train_length
+    global target_train, target_test, target_fake, features_count, features_density, features_deviation, features_pred, store
+    import pandas as pd
+
+    train = data.load(data_path + 'train.csv', os.path.join(cache_path, 'train'))
+    test = data.load(data_path + 'test.csv', os.path.join(cache_path, 'test'))
+
+    indices_fake = np.load(indices_path + 'synthetic_samples_indexes.npy')
+    indices_pub = np.load(indices_path + 'public_LB.npy')
+    indices_pri = np.load(indices_path + 'private_LB.npy')
+    indices_real = np.concatenate([indices_pub, indices_pri])
+
+    features = train.columns
+    X_train = train.view(np.arange(len(train)))
+    X_test = test.view(indices_real)
+    X_fake = test.view(indices_fake)
+    train_length = len(X_train)
+
+    if use_experimental:
+        np.random.seed(42)    
+        indices = np.arange(train_length)
+        train_length = 150000
+        np.random.shuffle(indices)
+        indices_train = indices[:train_length]
+        indices_test = indices[train_length:]
+        X_test = train.view(indices_test)
+        X_fake = train.view(indices_test)
+        X_train = train.view(indices_train)
+
+    target_train = pd.Series(X_train.target, index=X_train.index())
+    target_test = pd.Series(X_test.target, index=X_test.index()).astype(float)
+    target_fake = pd.Series(X_fake.target, index=X_fake.index()).astype(float)
+
+    features_count = [var+'_count' for var in features]
+    features_density = [var+'_density' for var in features]
+    features_deviation = [var+'_deviation' for var in features]
+    features_pred = [var+'_pred' for var in features]
+
+    store = FeatureStore(
+        [('train', len(X_train)), ('test', len(X_test)), ('fake', len(X_fake))],
+        [('raw', features), ('count', features_count), ('density', features_density), ('deviation', features_deviation), ('pred', features_pred)],
+        dtype=store_dtype, path=store_path)
+    X_train.get_values(out=store.get('raw', 'train'))
+    X_test.get_values(out=store.get('raw', 'test'))
+    X_fake.get_values(out=store.get('raw', 'fake'))
+    print(store.values.shape, '{:.2f} GB'.format(store.nbytes / 1e9))
+    if refit_path:
+        load_previous()
 
 # Feature Engineering
 # Counts, Density, Deviation
 # Here I calculate the unique counts of each faeture seaparately. Based on that I also calculate the density by smoothing the counts and also the deviation as counts/density.
 
-import scipy.ndimage
-
-sigma_fac = 0.001
-sigma_base = 4
-
-eps = 0.00000001
-
-def get_count(X_all, X_fake):
-    features_count = np.zeros((X_all.shape[0], len(features)))
-    features_density = np.zeros((X_all.shape[0], len(features)))
-    features_deviation = np.zeros((X_all.shape[0], len(features)))
-
-    features_count_fake = np.zeros((X_fake.shape[0], len(features)))
-    features_density_fake = np.zeros((X_fake.shape[0], len(features)))
-    features_deviation_fake = np.zeros((X_fake.shape[0], len(features)))
-    
-    sigmas = []
-
-    for i,var in enumerate(tqdm(features)):
-        X_all_var_int = (X_all[var].values * 10000).round().astype(int)
-        X_fake_var_int = (X_fake[var].values * 10000).round().astype(int)
-        lo = X_all_var_int.min()
-        X_all_var_int -= lo
-        X_fake_var_int -= lo
-        hi = X_all_var_int.max()+1
-        counts_all = np.bincount(X_all_var_int, minlength=hi).astype(float)
-        zeros = (counts_all == 0).astype(int)
-        before_zeros = np.concatenate([zeros[1:],[0]])
-        indices_all = np.arange(counts_all.shape[0])
-        # Geometric mean of twice sigma_base and a sigma_scaled which is scaled to the length of array 
-        sigma_scaled = counts_all.shape[0]*sigma_fac
-        sigma = np.power(sigma_base * sigma_base * sigma_scaled, 1/3)
-        sigmas.append(sigma)
-        counts_all_smooth = scipy.ndimage.filters.gaussian_filter1d(counts_all, sigma)
-        deviation = counts_all / (counts_all_smooth+eps)
-        indices = X_all_var_int
-        features_count[:,i] = counts_all[indices]
-        features_density[:,i] = counts_all_smooth[indices]
-        features_deviation[:,i] = deviation[indices]
-        indices_fake = X_fake_var_int
-        features_count_fake[:,i] = counts_all[indices_fake]
-        features_density_fake[:,i] = counts_all_smooth[indices_fake]
-        features_deviation_fake[:,i] = deviation[indices_fake]
-        
-    features_count_names = [var+'_count' for var in features]
-    features_density_names = [var+'_density' for var in features]
-    features_deviation_names = [var+'_deviation' for var in features]
-
-    X_all_count = pd.DataFrame(columns=features_count_names, data = features_count)
-    X_all_count.index = X_all.index
-    X_all_density = pd.DataFrame(columns=features_density_names, data = features_density)
-    X_all_density.index = X_all.index
-    X_all_deviation = pd.DataFrame(columns=features_deviation_names, data = features_deviation)
-    X_all_deviation.index = X_all.index
-    X_all = pd.concat([X_all,X_all_count, X_all_density, X_all_deviation], axis=1)
-    
-    X_fake_count = pd.DataFrame(columns=features_count_names, data = features_count_fake)
-    X_fake_count.index = X_fake.index
-    X_fake_density = pd.DataFrame(columns=features_density_names, data = features_density_fake)
-    X_fake_density.index = X_fake.index
-    X_fake_deviation = pd.DataFrame(columns=features_deviation_names, data = features_deviation_fake)
-    X_fake_deviation.index = X_fake.index
-    X_fake = pd.concat([X_fake,X_fake_count, X_fake_density, X_fake_deviation], axis=1)    
-
-    features_count = features_count_names
-    features_density = features_density_names
-    features_deviation = features_deviation_names
-    return X_all, features_count, features_density, features_deviation, X_fake
-
-X_all, features_count, features_density, features_deviation, X_fake = get_count(X_all, X_fake)
-print(X_all.shape)
+from santander.frequency import FrequencyTables
+from santander import scoring
+from santander import lut
+from santander import cache
+from santander import metrics
+
+# Everything needed to score new rows without retraining (frequency tables, scaler, trees, CNNs) is saved to model_path, see
+# santander/scoring.py. Set to None to not save anything. The stages write into model_path + '.partial', which only replaces model_path
+# after the submit stage, so a crashed (or --until) run never leaves a mix of two runs in model_path for the scorer to load.
+model_path = 'model'
+
+# Incremental refit
+# For daily refits on appended data set refit_path to the model directory of the previous run (its train.csv / test.csv rows must be the
+# first rows of the current ones), the refitted model is written to model_path. Instead of starting from scratch:
+# - the frequency tables of the previous run are updated with the counts of the new rows (FrequencyTables.update)
+# - the previous scaler is reused, so the boosters and CNNs continue on inputs with the same scale
+# - every fold booster continues boosting from the previous one (init_model) for at most refit_rounds rounds on the new rows of its fold
+# - every CNN fold is fine-tuned from the previous weights for refit_epochs epochs on the new rows of its fold
+# The old rows keep the folds of the previous run and the new rows are split into folds on their own, so the out-of-fold predictions stay
+# out of fold. The fold of every row is saved to folds/ of the model directory (one file per variable and one for the CNN), so this also
+# holds after any number of refits. Training only sees the new rows, features and predictions are still computed for all rows (which is cheap next to training).
+# The out-of-fold metrics of the trees and the CNN are saved to metrics.json, a refit compares them to the previous run and writes the
+# drift to drift.json.
+refit_path = None
+refit_rounds = 200
+refit_epochs = 3
+# Rows of train.csv / test.csv and the metrics of the previous run (set by load_previous)
+n_rows_previous = {'train': 0, 'test': 0}
+metrics_previous = {}
+
+def load_previous():
+    global n_rows_previous, metrics_previous
+    if os.path.abspath(refit_path) == os.path.abspath(model_path):
+        raise ValueError('refit_path must not be model_path, the previous model is read while the new one is written')
+    with open(os.path.join(refit_path, 'meta.json')) as f:
+        n_rows_previous = json.load(f)['n_rows']
+    metrics_previous = {}
+    if os.path.exists(os.path.join(refit_path, 'metrics.json')):
+        with open(os.path.join(refit_path, 'metrics.json')) as f:
+            metrics_previous = json.load(f)
+
+def get_folds_path(path, name):
+    return os.path.join(path, 'folds', name + '.npy')
+
+def split_folds(folds, y, name, save=False):
+    # Folds of all rows as (trn_idx, val_idx), on a refit the old rows get their fold of the previous run (read from its folds/{name}.npy)
+    # and only the new rows are split. With save the fold of every row is written to the model directory for the next refit.
+    n = n_rows_previous['train']
+    fold_ids = np.empty(len(y), dtype=np.int8)
+    if n > 0:
+        fold_ids[:n] = np.load(get_folds_path(refit_path, name))
+    if len(y) - n >= folds.get_n_splits():
+        for k, (trn_idx, val_idx) in enumerate(folds.split(np.zeros(len(y) - n), y[n:])):
+            fold_ids[n + val_idx] = k
+    else:
+        # Too few new rows to split, they go to the folds in turn
+        fold_ids[n:] = np.arange(len(y) - n) % folds.get_n_splits()
+    if save and model_path:
+        os.makedirs(os.path.dirname(get_folds_path(model_path, name)), exist_ok=True)
+        np.save(get_folds_path(model_path, name), fold_ids)
+    return [(np.flatnonzero(fold_ids != k), np.flatnonzero(fold_ids == k)) for k in range(folds.get_n_splits())]
+
+def get_new_rows(dataset):
+    # Store rows of train / test that were appended to the csv files since the previous run. n_rows_previous holds the csv lengths, the
+    # real test rows are ordered public LB first, so new test rows are found by their row in test.csv and not by their position in the store.
+    if dataset == 'test':
+        return np.flatnonzero(indices_real >= n_rows_previous['test'])
+    return np.arange(n_rows_previous['train'], store.n_rows('train'))
+
+def get_auc_new(y, p):
+    # AUC of the rows added since the previous run, None if there are none
+    n = n_rows_previous['train']
+    return metrics.auc(y[n:], p[n:]) if len(y) > n else None
+
+def update_json(path, key, value):
+    content = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            content = json.load(f)
+    content[key] = value
+    with open(path, 'w') as f:
+        json.dump(content, f, indent=1)
+
+def save_metrics(name, values):
+    # Out-of-fold metrics of a stage in metrics.json, on a refit their change against the previous run is printed and saved in drift.json.
+    # List values (one per var) are compared element wise, only the largest change is printed. Non-numeric values (flags like applied of
+    # the smoothing, oof_auc_new without new rows) are only saved.
+    if not model_path:
+        return
+    update_json(os.path.join(model_path, 'metrics.json'), name, values)
+    if not refit_path or name not in metrics_previous:
+        return
+    drift = {}
+    for key, value in values.items():
+        if key not in metrics_previous[name]:
+            continue
+        if not all(np.issubdtype(np.array(v).dtype, np.number) for v in [value, metrics_previous[name][key]]):
+            continue
+        previous = metrics_previous[name][key]
+        change = (np.array(value) - np.array(previous)).tolist()
+        drift[key] = {'previous': previous, 'current': value, 'change': change}
+        if np.isscalar(change):
+            print('drift {} {:<12}: {:<8.5f} -> {:<8.5f} ({:+.5f})'.format(name, key, previous, value, change))
+        else:
+            i = int(np.argmax(np.abs(change)))
+            print('drift {} {:<12}: largest change {} {:<8.5f} -> {:<8.5f} ({:+.5f})'.format(name, key, i, previous[i], value[i], change[i]))
+    update_json(os.path.join(model_path, 'drift.json'), name, drift)
+
+# Threads for the frequency tables. With store_dtype = np.float64 the features are bit for bit identical to the original per column loop
+# (santander.frequency.check_tables verifies that). The tables are saved to frequency_tables/ of the model directory, so new rows can be
+# scored with FrequencyTables.load(path).lookup(df) without reloading train and test.
+n_jobs_count = 8
+
+def get_count():
+    if model_path:
+        scoring.save_meta(model_path, features, n_folds, n_splits, {'train': len(train), 'test': len(test)}, dtype=store.dtype)
+    X_all = store.get('raw', ['train', 'test'])
+    with profiler.stage('fit'):
+        if refit_path:
+            tables = FrequencyTables.load(scoring.get_frequency_tables_path(refit_path), mmap_mode=None, n_jobs=n_jobs_count)
+            for dataset in ['train', 'test']:
+                tables.update(store.get('raw', dataset)[get_new_rows(dataset)])
+        else:
+            tables = FrequencyTables.fit_stream((X_all[rows] for rows in store.get_shards(['train', 'test'], shard_size)), columns=features, n_jobs=n_jobs_count)
+        if model_path:
+            tables.save(scoring.get_frequency_tables_path(model_path))
+    with profiler.stage('transform'):
+        for datasets in [['train', 'test'], 'fake']:
+            out = [store.get(family, datasets) for family in ['count', 'density', 'deviation']]
+            tables.transform(store.get('raw', datasets), out=out, shard_size=shard_size)
 
 # Target encoding (unused)
 # NB predictor (unused)
 # Standardize
 # I standardize all the features (or supposedly so, apparently I forgot density and deviation being in time trouble). Which is important for later NN usage.
 
-features_to_scale = [features, features_count]
-
-from sklearn.preprocessing import StandardScaler
+features_to_scale = ['raw', 'count']
 
-def get_standardized(X_all, X_fake):
+def get_standardized():
+    from sklearn.preprocessing import StandardScaler
+    # With a single shard partial_fit is the same as fit
     scaler = StandardScaler()
-    features_to_scale_flatten = [var for sublist in features_to_scale for var in sublist]
-    scaler.fit(X_all[features_to_scale_flatten])
-    features_scaled = scaler.transform(X_all[features_to_scale_flatten])
-    features_scaled_fake = scaler.transform(X_fake[features_to_scale_flatten])
-    X_all[features_to_scale_flatten] = features_scaled
-    X_fake[features_to_scale_flatten] = features_scaled_fake
-    return X_all, X_fake
-
-X_all, X_fake = get_standardized(X_all, X_fake)
-
-print(X_all.shape)
-
-# Rotated features (unused)
-# PCA (unused)
-# Setting up Dataframes
-# After performing FE on X_all, I split it back into train/test and delete the obsolete dataframe. The latter is a reoccuring theme in this kernel and was necessary as I often experienced memory overflow. This is also the reason why I wrote most of the code inside of functions. Shoutout to kaggle however for providing fast GPUs!
-
-X_train = X_all.iloc[:train_length,:]
-X_test = X_all.iloc[train_length:,:]
-del X_all
-import gc
-gc.collect()
-print(X_train.shape, X_test.shape)
+    X_all = store.get(features_to_scale, ['train', 'test'])
+    with profiler.stage('fit'):
+        if refit_path:
+            scaler_previous = np.load(os.path.join(refit_path, 'scaler.npz'))
+            scaler.mean_, scaler.scale_ = scaler_previous['mean'], scaler_previous['scale']
+        else:
+            for rows in store.get_shards(['train', 'test'], shard_size):
+                scaler.partial_fit(X_all[rows])
+        if model_path:
+            scoring.save_scaler(model_path, scaler)
+    # Same as scaler.transform, but in place on the store (fake rows included). mean / scale are rounded to the store dtype first, so the
+    # operations run in float32 without float64 temporaries (scoring.Scorer repeats exactly these two steps).
+    with profiler.stage('transform'):
+        features_scaled = store.get(features_to_scale)
+        mean = scaler.mean_.astype(store.dtype)
+        scale = scaler.scale_.astype(store.dtype)
+        for rows in store.get_shards(None, shard_size):
+            features_scaled[rows] -= mean
+            features_scaled[rows] /= scale
+
+    # Rotated features (unused)
+    # PCA (unused)
+    # Setting up Dataframes
+    # After performing FE on X_all, I split it back into train/test and delete the obsolete dataframe. The latter is a reoccuring theme in this kernel and was necessary as I often experienced memory overflow. This is also the reason why I wrote most of the code inside of functions. Shoutout to kaggle however for providing fast GPUs!
+    # With the feature store there is nothing left to split or delete, train and test are row views of the store.
+    print(store.get(None, 'train').shape, store.get(None, 'test').shape)
 # LGBM
 # Many public kernels indicated that the features are independent, conditional on the target. For this reason I train seperate trees for each feature and their respective counts. Using a simple average (of the square root) of all tree predictors achieves around 0.9225 / 0.9205 on public/private LB.
 
-# features_used = [features, features_count]
+features_used = ['raw', 'count']
 # Params
 # Parameters of the LGBM model. I choose l1 regularization / max_bin / learning rate and num_leaves seaprately for each of the 200 var_x through earlier hyperparam search.
 
@@ -207,6 +320,21 @@ learning_rate_var = [2, 2, 2, 1, 2, 2, 2, 0, 1, 2, 0, 2, 2, 2, 0, 2, 2, 0, 2, 1,
 # num_leaves
 num_leaves_values = [3, 4, 5]
 num_leaves_var = [1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 1, 0, 2, 0, 1, 0, 0, 0, 0, 0, 0, 1, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 2, 2, 1, 0, 0, 0, 1, 0, 0, 0, 0, 0, 2, 0, 0, 0, 0, 1, 0, 1, 0, 1, 0, 0, 2, 1, 2, 0, 0, 0, 0, 0, 1, 1, 0, 0, 2, 1, 0, 1, 0, 0, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 1, 1, 2, 0, 0, 0, 0, 1, 0, 1, 2, 1, 1, 1, 0, 2, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 2, 0, 1, 2, 0, 1, 0, 2, 2, 0, 1, 1, 0, 0, 0, 1, 1, 0, 0, 0, 0, 1, 0, 1, 1, 0, 1, 2, 0, 0, 0, 1, 0, 1, 1, 0, 1, 0, 1, 0, 2, 0, 0, 0, 0, 1, 0, 0, 2, 1, 0, 1, 2, 1, 1, 0, 0, 0, 2, 1, 2]
+# Hyperparameter search
+# The tables above came from an offline search. With search_params = True they are regenerated: every variable evaluates the grid of the
+# four *_values lists with successive halving over its folds (santander/search.py), the variables are spread over the same process pool
+# setup as train_trees (n_jobs_trees) and the winning indices replace the *_var tables and are written to param_tables_path. A table file
+# from an earlier search is loaded when search_params is False (it lives next to profile.json and not in the model directory, which is
+# only published after the run and replaced by every run).
+search_params = False
+search_prune_factor = 2
+param_tables_path = 'param_tables.json'
+
+def load_param_tables():
+    if param_tables_path and os.path.exists(param_tables_path) and not search_params:
+        with open(param_tables_path) as f:
+            globals().update(json.load(f))
+
 # Training
 # A little discussion I had with Chua in this markdown cell. Thats probably not the most efficient way of communicating :D.
 
@@ -221,154 +349,398 @@ num_leaves_var = [1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 1, 0, 0,
 n_folds = 5
 early_stopping_rounds=10
 settings = [4]
-np.random.seed(47)
+
+# Number of worker processes for the per-variable trees. Each booster is tiny (3-5 leaves on 1-2 columns), so instead of giving a single
+# lgb.train call 8 threads I spread the variables over a process pool with one LightGBM thread per worker. The workers are forked, so they
+# see the training data without copying it. Fold seeds are still drawn in the serial order from np.random.seed(47) and the results are
+# accumulated in the same order as in the serial run, so the preds_* matrices don't depend on n_jobs_trees.
+n_jobs_trees = 1
+# Predict with a lookup table compiled from the booster (santander/lut.py) instead of clf.predict. The predictions are identical, but one
+# searchsorted + gather per column is an order of magnitude faster than LightGBM's generic predictor for these tiny trees.
+predict_lut = True
+# Every finished variable is written to a content-addressed cache, keyed by its input columns, the target, its params for every setting, the
+# fold seed and the training options. If train_trees crashes or is pre-empted a rerun skips all variables that are already done, and changing
+# the hyperparameters of a single variable only retrains that variable. Off by default, set tree_cache_path to a directory to enable it.
+# Entries hold the predictions (in the store dtype, about 8 MB per variable in float32 on the full data) and the boosters of every fold,
+# after train_trees the least recently used entries are evicted down to tree_cache_size bytes, so old inputs (e.g. of earlier refits) don't
+# pile up.
+tree_cache_path = None
+tree_cache_size = 4 * 10**9
+# Predicting and scoring the training part of every fold is only used for logging (and for the unused features_train of the CNN), but costs
+# a full prediction over 4/5 of the train set per fold. Set to False to skip it.
+score_train = True
 
 settings_best_ind = []
 
-def train_trees():
-    preds_oof = np.zeros((len(X_train), len(features)))
-    preds_test = np.zeros((len(X_test), len(features)))
-    preds_train = np.zeros((len(X_train), len(features)))
-    preds_fake = np.zeros((len(X_fake), len(features)))
+def get_params(i, setting):
+    params_var = copy(params)
+    params_var['max_bin'] = max_bin_values[max_bin_var[i]]
+    params_var['learning_rate'] = learning_rate_values[learning_rate_var[i]]
+    params_var['reg_alpha'] = reg_alpha_values[reg_alpha_var[i]]
+    params_var['num_leaves'] = num_leaves_values[num_leaves_var[i]]
+    # setting is used for hyperparameter tuning, here you can add sometinh like params_var['num_leaves'] = setting
+    if n_jobs_trees > 1:
+        params_var['num_threads'] = 1
+    return params_var
+
+def get_folds(i, seed, save=False):
+    from sklearn.model_selection import StratifiedKFold
+    folds = StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=seed)
+    return split_folds(folds, target_train.values, f'var_{i}', save=save)
+
+def get_tree_input(i, dataset, idx=None):
+    # The features_used columns of var i, only these are copied out of the store
+    return store.take([store.cols[family].start + i for family in features_used], dataset, idx)
+
+def train_fold(data, params_var, X_var, X_var_test, X_var_fake, trn_idx, val_idx, profiler_var, init_model=None):
+    # The fold datasets are subsets of the binned training data of the variable, LightGBM reuses its bins instead of binning again. On a
+    # refit data only holds the new rows and the booster continues from init_model on the new rows of the fold.
+    import lightgbm as lgb
+    n = n_rows_previous['train']
+    with profiler_var.stage('train'):
+        trn_new = trn_idx[trn_idx >= n] - n
+        val_new = val_idx[val_idx >= n] - n
+        if init_model is not None and (len(trn_new) == 0 or len(val_new) == 0):
+            clf = init_model
+        else:
+            trn_data = data.subset(trn_new)
+            val_data = data.subset(val_new)
+
+            # Binary Log Loss
+            num_boost_round = 2000 if init_model is None else refit_rounds
+            clf = lgb.train(params_var, trn_data, num_boost_round, valid_sets=[trn_data, val_data], init_model=init_model,
+                            callbacks=[lgb.early_stopping(early_stopping_rounds, verbose=False), lgb.log_evaluation(0)])
+
+    with profiler_var.stage('predict'):
+        predict = lut.compile_booster(clf).predict if predict_lut else clf.predict
+        # In the store dtype, with the float32 store this also halves the tree cache entries
+        prediction_val1 = predict(X_var[val_idx]).astype(store.dtype)
+        prediction_test1 = predict(X_var_test).astype(store.dtype)
+        prediction_train1 = predict(X_var[trn_idx]).astype(store.dtype) if score_train else None
+        prediction_fake1 = predict(X_var_fake).astype(store.dtype)
+    return prediction_val1, prediction_test1, prediction_train1, prediction_fake1, clf.feature_importance(), clf.model_to_string()
+
+def train_var(job):
+    # Trains all settings and folds of var i, runs in the worker processes if n_jobs_trees > 1. The inputs of the variable are copied out of
+    # the store once and the training data is binned once per max_bin, all folds and settings with that max_bin reuse it. (Settings that
+    # change other dataset parameters than max_bin would need their own key here.) Returns the results and the profiler records of the var.
+    import lightgbm as lgb
+    i, seed = job
+    profiler_var = profiling.Profiler(enabled=profiler.enabled, trace_allocations=profiler.trace_allocations)
+    with profiler_var.stage('input', var=i):
+        X_var = get_tree_input(i, 'train')
+        X_var_test = get_tree_input(i, 'test')
+        X_var_fake = get_tree_input(i, 'fake')
+    # num_threads doesn't change the results, so serial and parallel runs share the cache
+    list_params = [{key: value for key, value in get_params(i, setting).items() if key != 'num_threads'} for setting in settings]
+    init_models = [None] * n_folds
+    key_parts = [X_var, X_var_test, X_var_fake, target_train.values, list_params, settings, seed, n_folds, early_stopping_rounds, predict_lut,
+                 score_train, lgb.__version__]
+    list_folds = get_folds(i, seed)
+    if refit_path:
+        # The folds of the old rows come from the previous model directory, not from the seed
+        init_models = [lgb.Booster(model_file=scoring.get_tree_path(refit_path, i, k)) for k in range(n_folds)]
+        key_parts += [n_rows_previous, refit_rounds, [clf.model_to_string() for clf in init_models]] + [val_idx for trn_idx, val_idx in list_folds]
+    if tree_cache_path:
+        key = cache.get_key(*key_parts)
+        with profiler_var.stage('cache', var=i):
+            entry = cache.load(tree_cache_path, key)
+        if entry is not None:
+            return entry['results'], profiler_var.records
+
+    datasets = {}
+    results = []
+    for j, setting in enumerate(settings):
+        params_var = get_params(i, setting)
+        if params_var['max_bin'] not in datasets:
+            with profiler_var.stage('dataset', var=i, max_bin=params_var['max_bin']):
+                # Without new rows on a refit every fold keeps its init_model (see train_fold)
+                n = n_rows_previous['train']
+                datasets[params_var['max_bin']] = None
+                if len(X_var) > n:
+                    datasets[params_var['max_bin']] = lgb.Dataset(X_var[n:], label=target_train.values[n:], params=params_var, free_raw_data=False).construct()
+        for k, (trn_idx, val_idx) in enumerate(list_folds):
+            with profiler_var.stage('fold', var=i, setting=setting, fold=k):
+                results.append(train_fold(datasets[params_var['max_bin']], params_var, X_var, X_var_test, X_var_fake, trn_idx, val_idx, profiler_var, init_models[k]))
+    if tree_cache_path:
+        hyperparams = {'max_bin_var': max_bin_var[i], 'learning_rate_var': learning_rate_var[i], 'reg_alpha_var': reg_alpha_var[i],
+                       'num_leaves_var': num_leaves_var[i], 'seed': seed}
+        cache.save(tree_cache_path, key, {'var': features[i], 'hyperparams': hyperparams, 'params': list_params, 'results': results})
+    return results, profiler_var.records
+
+def search_var(job):
+    from santander import search
+    i, seed = job
+    params_var = copy(params)
+    if n_jobs_trees > 1:
+        params_var['num_threads'] = 1
+    grid = {'reg_alpha': reg_alpha_values, 'max_bin': max_bin_values, 'learning_rate': learning_rate_values, 'num_leaves': num_leaves_values}
+    return search.search_var(get_tree_input(i, 'train'), target_train.values, get_folds(i, seed), params_var, grid,
+                             prune_factor=search_prune_factor, early_stopping_rounds=early_stopping_rounds)
+
+def search_param_tables():
+    if not param_tables_path:
+        raise ValueError('search_params needs param_tables_path to write the winning tables to')
+    # Same fold seeds as train_trees, without consuming them from np.random
+    random_state = np.random.RandomState(47)
+    seeds = [random_state.randint(100000) for i in range(len(features))]
+    jobs = [(i, seeds[i]) for i in range(len(features))]
+    if n_jobs_trees > 1:
+        with Pool(n_jobs_trees) as pool:
+            results = pool.map(search_var, jobs)
+    else:
+        results = list(map(search_var, jobs))
+    tables = {
+        'reg_alpha_var': [int(best['reg_alpha']) for best, loss in results],
+        'max_bin_var': [int(best['max_bin']) for best, loss in results],
+        'learning_rate_var': [int(best['learning_rate']) for best, loss in results],
+        'num_leaves_var': [int(best['num_leaves']) for best, loss in results],
+    }
+    for i, (best, loss) in enumerate(results):
+        print('{} - oof loss: {:<8.3f} - {}'.format(features[i], loss*1000, best))
+    with open(param_tables_path, 'w') as f:
+        json.dump(tables, f)
+    print('Parameter tables written to {}'.format(param_tables_path))
+    return tables
 
-    features_used_flatten = [var for sublist in features_used for var in sublist]
-    X_train_used = X_train[features_used_flatten]
-    X_test_used = X_test[features_used_flatten]
-    X_fake_used = X_fake[features_used_flatten]
+def train_trees():
+    # oof / test / fake predictions are written into the pred family of the store. The cumulative scores after every variable are kept
+    # as running sums (santander/metrics.py) and returned in history for the summary. With smooth_preds or report_smoothing the smoothed
+    # oof predictions and the curves for smooth_predictions are computed along the way (see there), otherwise both are None.
+    from santander import smoothing
+    use_smoothing = smooth_preds or report_smoothing
+    preds_oof = store.get('pred', 'train')
+    preds_test = store.get('pred', 'test')
+    preds_train = store.empty('preds_train', (store.n_rows('train'), len(features)), dtype=store.dtype)
+    preds_fake = store.get('pred', 'fake')
+    if use_smoothing:
+        preds_oof_smooth = store.empty('preds_oof_smooth', (store.n_rows('train'), len(features)), dtype=store.dtype)
+        curve_values = np.zeros((len(features), n_folds, n_points_smooth))
+        curve_range = np.zeros((len(features), 2))
+    # Mean test prediction of every booster, used in place of the batch mean in the sqrt transform when scoring
+    tree_means = np.zeros((len(features), n_folds))
+    y_train = target_train.values
+    y_test = target_test.values
+    cum_oof = metrics.CumulativeScore(y_train)
+    cum_test = metrics.CumulativeScore(y_test)
+    cum_train = metrics.CumulativeScore(y_train)
+    history = {'val': [], 'test': [], 'train': []}
+
+    # Draw all fold seeds up front, in the same order as the serial loop did
+    seeds = [np.random.randint(100000) for i in range(len(features))]
+    jobs = ((i, seeds[i]) for i in range(len(features)))
+    # imap keeps the job order, so the workers can run ahead while the results below are consumed exactly like in the serial run
+    pool = Pool(n_jobs_trees) if n_jobs_trees > 1 else None
+    results = pool.imap(train_var, jobs) if pool is not None else map(train_var, jobs)
 
     for i in range(len(features)):
-        params['max_bin'] = max_bin_values[max_bin_var[i]]
-        params['learning_rate'] = learning_rate_values[learning_rate_var[i]]
-        params['reg_alpha'] = reg_alpha_values[reg_alpha_var[i]]
-        params['num_leaves'] = num_leaves_values[num_leaves_var[i]]
-        features_train = [feature_set[i] for feature_set in features_used] 
+        features_train = [store.names[family][i] for family in features_used]
         print(f'Training on: {features_train}')
-        folds = StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=np.random.randint(100000))
-        list_folds = list(folds.split(X_train_used.values, target_train.values))
-        preds_oof_temp = np.zeros((preds_oof.shape[0], len(settings)))
-        preds_test_temp = np.zeros((preds_test.shape[0], len(settings)))
-        preds_train_temp = np.zeros((preds_train.shape[0], len(settings)))
-        preds_fake_temp = np.zeros((preds_fake.shape[0], len(settings)))
-
-        scores = []
-        for j, setting in enumerate(settings):
-            # setting is used for hyperparameter tuning, here you can add sometinh like params['num_leaves'] = setting
-            print('\nsetting: ', setting)
-            for k, (trn_idx, val_idx) in enumerate(list_folds):
-                print("Fold: {}".format(k+1), end="")
-                trn_data = lgb.Dataset(X_train_used.iloc[trn_idx][features_train], label=target_train.iloc[trn_idx])
-                val_data = lgb.Dataset(X_train_used.iloc[val_idx][features_train], label=target_train.iloc[val_idx])
-
-                # Binary Log Loss
-                clf = lgb.train(params, trn_data, 2000, valid_sets=[trn_data, val_data], verbose_eval=False, early_stopping_rounds=early_stopping_rounds) 
-
-                prediction_val1 = clf.predict(X_train_used.iloc[val_idx][features_train])
-                prediction_test1 = clf.predict(X_test_used[features_train])
-                prediction_train1 = clf.predict(X_train_used.iloc[trn_idx][features_train])
-                prediction_fake1 = clf.predict(X_fake_used[features_train])
-
-                # Predictions
-                s1 = roc_auc_score(target_train.iloc[val_idx], prediction_val1)
-                s1_log = log_loss(target_train.iloc[val_idx], prediction_val1)
-                print(' - val AUC: {:<8.4f} - loss: {:<8.3f}'.format(s1, s1_log*1000), end='')
-
-                # Predictions Test
-                if use_experimental:
-                    s1_test = roc_auc_score(target_test, prediction_test1)
-                    s1_log_test = log_loss(target_test, prediction_test1)
-                    print(' - test AUC: {:<8.4f} - loss: {:<8.3f}'.format(s1_test, s1_log_test*1000), end='')
-
-                # Predictions Train
-                s1_train = roc_auc_score(target_train.iloc[trn_idx], prediction_train1)
-                s1_log_train = log_loss(target_train.iloc[trn_idx], prediction_train1)
-                print(' - train AUC: {:<8.4f} - loss: {:<8.3f}'.format(s1_train, s1_log_train*1000), end='')
+        list_folds = get_folds(i, seeds[i], save=True)
+        results_var, records = next(results)
+        profiler.extend(records)
+        results_var = iter(results_var)
+        with profiler.stage('score', var=i):
+            # float64, the per setting log loss below is compared to pick the best setting (only the chosen column goes into the store)
+            preds_oof_temp = np.zeros((preds_oof.shape[0], len(settings)))
+            preds_test_temp = np.zeros((preds_test.shape[0], len(settings)))
+            preds_train_temp = np.zeros((preds_train.shape[0], len(settings)))
+            preds_fake_temp = np.zeros((preds_fake.shape[0], len(settings)))
+
+            model_strings = [[] for setting in settings]
+            tree_means_temp = np.zeros((len(settings), n_folds))
+            signal_test = store.column('raw', i, 'test')
+            if use_smoothing:
+                curves_temp = np.zeros((len(settings), n_folds, n_points_smooth))
+
+            scores = []
+            for j, setting in enumerate(settings):
+                print('\nsetting: ', setting)
+                for k, (trn_idx, val_idx) in enumerate(list_folds):
+                    print("Fold: {}".format(k+1), end="")
+                    prediction_val1, prediction_test1, prediction_train1, prediction_fake1, feature_importance, model_string = next(results_var)
+                    model_strings[j].append(model_string)
+                    tree_means_temp[j,k] = prediction_test1.mean()
+
+                    # Predictions
+                    s1 = metrics.auc(y_train[val_idx], prediction_val1)
+                    s1_log = metrics.log_loss(y_train[val_idx], prediction_val1)
+                    print(' - val AUC: {:<8.4f} - loss: {:<8.3f}'.format(s1, s1_log*1000), end='')
+
+                    # Predictions Test
+                    if use_experimental:
+                        s1_test = metrics.auc(y_test, prediction_test1)
+                        s1_log_test = metrics.log_loss(y_test, prediction_test1)
+                        print(' - test AUC: {:<8.4f} - loss: {:<8.3f}'.format(s1_test, s1_log_test*1000), end='')
+
+                    # Predictions Train
+                    if score_train:
+                        s1_train = metrics.auc(y_train[trn_idx], prediction_train1)
+                        s1_log_train = metrics.log_loss(y_train[trn_idx], prediction_train1)
+                        print(' - train AUC: {:<8.4f} - loss: {:<8.3f}'.format(s1_train, s1_log_train*1000), end='')
+                    if use_experimental:
+                        print('',feature_importance, end='')
+
+                    print('')
+
+
+                    preds_oof_temp[val_idx,j] += np.sqrt(prediction_val1 - prediction_val1.mean() + 0.1) 
+                    preds_test_temp[:,j] += np.sqrt(prediction_test1 - prediction_test1.mean() + 0.1) / n_folds
+                    if score_train:
+                        preds_train_temp[trn_idx,j] += np.sqrt(prediction_train1 - prediction_train1.mean() + 0.1) / (n_folds-1)
+                    preds_fake_temp[:,j] += np.sqrt(prediction_fake1 - prediction_fake1.mean() + 0.1) / n_folds
+                    if use_smoothing:
+                        curves_temp[j,k] = smoothing.fit_curve(signal_test, np.sqrt(prediction_test1 - prediction_test1.mean() + 0.1),
+                                                               n_points_smooth, sigma_smooth)
+
+                score_setting = metrics.auc(y_train, preds_oof_temp[:,j])
+                score_setting_log = 1000*metrics.log_loss(y_train, np.exp(preds_oof_temp[:,j]))
+                scores.append(score_setting_log)
+                print("Score:  - val AUC: {:<8.4f} - loss: {:<8.3f}".format(score_setting, score_setting_log), end='')
                 if use_experimental:
-                    print('',clf.feature_importance(), end='')
-
+                    score_setting_test = metrics.auc(y_test, preds_test_temp[:,j])
+                    score_setting_log_test = 1000*metrics.log_loss(y_test, np.exp(preds_test_temp[:,j]))
+                    print(" - test AUC: {:<8.4f} - loss: {:<8.3f}".format(score_setting_test, score_setting_log_test), end='')
+
+                if score_train:
+                    score_setting_train = metrics.auc(y_train, preds_train_temp[:,j])
+                    score_setting_log_train = 1000*metrics.log_loss(y_train, np.exp(preds_train_temp[:,j]))
+                    print(" - train AUC: {:<8.4f} - loss: {:<8.3f}".format(score_setting_train, score_setting_log_train), end='')
                 print('')
 
-
-                preds_oof_temp[val_idx,j] += np.sqrt(prediction_val1 - prediction_val1.mean() + 0.1) 
-                preds_test_temp[:,j] += np.sqrt(prediction_test1 - prediction_test1.mean() + 0.1) / n_folds
-                preds_train_temp[trn_idx,j] += np.sqrt(prediction_train1 - prediction_train1.mean() + 0.1) / (n_folds-1)
-                preds_fake_temp[:,j] += np.sqrt(prediction_fake1 - prediction_fake1.mean() + 0.1) / n_folds
-
-            score_setting = roc_auc_score(target_train, preds_oof_temp[:,j])
-            score_setting_log = 1000*log_loss(target_train, np.exp(preds_oof_temp[:,j]))
-            scores.append(score_setting_log)
-            print("Score:  - val AUC: {:<8.4f} - loss: {:<8.3f}".format(score_setting, score_setting_log), end='')
+            best_ind = np.argmin(scores)
+            settings_best_ind.append(best_ind)
+            preds_oof[:,i] = preds_oof_temp[:,best_ind]
+            preds_test[:,i] = preds_test_temp[:,best_ind]
+            preds_train[:,i] = preds_train_temp[:,best_ind]
+            preds_fake[:,i] = preds_fake_temp[:,best_ind]
+            tree_means[i] = tree_means_temp[best_ind]
+            if use_smoothing:
+                curve_values[i] = curves_temp[best_ind]
+                curve_range[i] = signal_test.min(), signal_test.max()
+                signal_train = store.column('raw', i, 'train')
+                for k, (trn_idx, val_idx) in enumerate(list_folds):
+                    preds_oof_smooth[val_idx,i] = smoothing.interp(signal_train[val_idx], *curve_range[i], curve_values[i,k])
+            if model_path:
+                scoring.save_trees(model_path, i, model_strings[best_ind])
+
+
+            print('\nbest setting: ', settings[best_ind])
+            cum_oof.add(preds_oof[:,i])
+            history['val'].append(cum_oof.auc())
+            print("Cum CV val  : {:<8.4f} - loss: {:<8.3f}".format(history['val'][-1], 1000*cum_oof.log_loss()))
             if use_experimental:
-                score_setting_test = roc_auc_score(target_test, preds_test_temp[:,j])
-                score_setting_log_test = 1000*log_loss(target_test, np.exp(preds_test_temp[:,j]))  
-                print(" - test AUC: {:<8.4f} - loss: {:<8.3f}".format(score_setting_test, score_setting_log_test), end='')
-
-            score_setting_train = roc_auc_score(target_train, preds_train_temp[:,j])
-            score_setting_log_train = 1000*log_loss(target_train, np.exp(preds_train_temp[:,j]))
-            print(" - train AUC: {:<8.4f} - loss: {:<8.3f}".format(score_setting_train, score_setting_log_train))
-
-        best_ind = np.argmin(scores)
-        settings_best_ind.append(best_ind)
-        preds_oof[:,i] = preds_oof_temp[:,best_ind]
-        preds_test[:,i] = preds_test_temp[:,best_ind]
-        preds_train[:,i] = preds_train_temp[:,best_ind]
-        preds_fake[:,i] = preds_fake_temp[:,best_ind]
-
-
-        print('\nbest setting: ', settings[best_ind])
-        preds_oof_cum = preds_oof[:,:i+1].mean(axis=1)
-        print("Cum CV val  : {:<8.4f} - loss: {:<8.3f}".format(roc_auc_score(target_train, preds_oof_cum), 1000*log_loss(target_train, np.exp(preds_oof_cum))))
-        if use_experimental:        
-            preds_test_cum = preds_test[:,:i+1].mean(axis=1)
-            print("Cum CV test : {:<8.4f} - loss: {:<8.3f}".format(roc_auc_score(target_test, preds_test_cum), 1000*log_loss(target_test, np.exp(preds_test_cum))))
-        preds_train_cum = preds_train[:,:i+1].mean(axis=1)
-        print("Cum CV train: {:<8.4f} - loss: {:<8.3f}".format(roc_auc_score(target_train, preds_train_cum), 1000*log_loss(target_train, np.exp(preds_train_cum))))
-        print('*****' * 10 + '\n')
-        
-    return preds_oof, preds_test, preds_train, preds_fake
-
-preds_oof, preds_test, preds_train, preds_fake = train_trees()
-
-# Training Summary
-preds_oof_cum = np.zeros(preds_oof.shape[0])
-if use_experimental:
-    preds_test_cum = np.zeros(preds_test.shape[0])
-preds_train_cum = np.zeros(preds_train.shape[0])
-for i in range(len(features)):
-    preds_oof_cum += preds_oof[:,i]
-    preds_train_cum += preds_train[:,i]
-    print("var_{} Cum val: {:<8.5f}".format(i,roc_auc_score(target_train, preds_oof_cum)), end="")
-    if use_experimental:
-        preds_test_cum += preds_test[:,i]
-        print(" - test : {:<8.5f}".format(roc_auc_score(target_test, preds_test_cum)), end="")
-    print(" - train: {:<8.5f}".format(roc_auc_score(target_train, preds_train_cum)))
+                cum_test.add(preds_test[:,i])
+                history['test'].append(cum_test.auc())
+                print("Cum CV test : {:<8.4f} - loss: {:<8.3f}".format(history['test'][-1], 1000*cum_test.log_loss()))
+            if score_train:
+                cum_train.add(preds_train[:,i])
+                history['train'].append(cum_train.auc())
+                print("Cum CV train: {:<8.4f} - loss: {:<8.3f}".format(history['train'][-1], 1000*cum_train.log_loss()))
+            print('*****' * 10 + '\n')
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if tree_cache_path:
+        cache.evict(tree_cache_path, tree_cache_size)
+    if model_path:
+        scoring.save_tree_means(model_path, tree_means)
+        scoring.save_lut(model_path, len(features), n_folds)
+    if use_smoothing:
+        curves = smoothing.SmoothCurves(curve_range[:,0], curve_range[:,1], curve_values.mean(axis=1))
+    else:
+        preds_oof_smooth = curves = None
+    return preds_oof, preds_test, preds_train, preds_fake, preds_oof_smooth, curves, history
+
+def run_trees():
+    global preds_oof, preds_test, preds_train, preds_fake, preds_oof_smooth, curves, history
+    load_param_tables()
+    if search_params:
+        globals().update(search_param_tables())
+    np.random.seed(47)
+    preds_oof, preds_test, preds_train, preds_fake, preds_oof_smooth, curves, history = train_trees()
+
+    # Training Summary
+    # The cumulative AUCs were already computed during training (the AUC of the cumulative sum equals the one of the cumulative mean)
+    for i in range(len(features)):
+        print("var_{} Cum val: {:<8.5f}".format(i,history['val'][i]), end="")
+        if use_experimental:
+            print(" - test : {:<8.5f}".format(history['test'][i]), end="")
+        if score_train:
+            print(" - train: {:<8.5f}".format(history['train'][i]), end="")
+        print('')
 
-print(settings)
-print(settings_best_ind)
+    print(settings)
+    print(settings_best_ind)
+
+    y_train = target_train.values
+    save_metrics('trees', {'oof_auc': history['val'][-1], 'oof_auc_new': get_auc_new(y_train, preds_oof.sum(axis=1)),
+                           'var_auc': [metrics.auc(y_train, preds_oof[:,i]) for i in range(len(features))]})
 
 # EDA on predictors
 # I plotted the predictions (sorted by feature), of the trees seaparately for the first 20 vars (x-axis corresponds to the z-score). The predictions are very noisy at the tails of the distributions, therefore I also tried using smoothed predictions (orange line) with no success however.
 
-from scipy.interpolate import interp1d
-from scipy.ndimage.filters import gaussian_filter
-import matplotlib.pyplot as plt 
-
+# Smoothing
+# The smoothed predictions are a pipeline stage (santander/smoothing.py). While training the trees, the test predictions of every fold
+# booster are smoothed into a curve over the variable (like in the plots), and the smoothed oof prediction of a row comes from the curve of
+# the fold it was left out of, so no row is smoothed with predictions of boosters that were trained on it. The average of the fold curves
+# of every variable is what test, fake and scoring use, all variables and rows in one vectorized interpolation. The curves cost a fit per
+# fold booster and a train sized array, so they are only computed with report_smoothing = True (or --report-smoothing), which reports the
+# oof AUC of the summed tree predictions with and without smoothing, or with smooth_preds = True (or --smooth), which also replaces the
+# tree predictions in the store with the smoothed ones, so the CNN is trained on them, and saves the curves to the model directory where
+# they replace the trees when scoring. Compare the cnn oof_auc in metrics.json of a run with and without it for the effect on the final model.
+smooth_preds = False
+report_smoothing = False
+n_points_smooth = 4000
+sigma_smooth = 10
+
+def smooth_predictions():
+    curves_path = scoring.get_curves_path(model_path) if model_path else None
+    if not smooth_preds:
+        # A model directory from an earlier smoothed run must not keep its curves
+        if curves_path and os.path.exists(curves_path):
+            os.remove(curves_path)
+    if curves is None:
+        return
+    y_train = target_train.values
+    scores = {'oof_auc': metrics.auc(y_train, preds_oof.sum(axis=1)), 'oof_auc_smooth': metrics.auc(y_train, preds_oof_smooth.sum(axis=1))}
+    print('Smoothing - oof AUC: {:<8.5f} - smoothed: {:<8.5f} ({:+.5f})'.format(scores['oof_auc'], scores['oof_auc_smooth'],
+                                                                               scores['oof_auc_smooth'] - scores['oof_auc']))
+    save_metrics('smoothing', dict(scores, applied=smooth_preds))
+    if not smooth_preds:
+        return
+    with profiler.stage('apply'):
+        preds_oof[:] = preds_oof_smooth
+        curves.predict(store.get('raw', 'test'), out=preds_test)
+        curves.predict(store.get('raw', 'fake'), out=preds_fake)
+        curves.predict(store.get('raw', 'train'), out=preds_train)
+    if curves_path:
+        curves.save(curves_path)
+
+# The plots are opt-in (plot = True or --plot [path]), they are the only use of matplotlib. The figure is saved to plot_path.
+
+plot = False
+plot_path = 'predictions.png'
 features_to_show = np.arange(20)
-plt.figure(figsize = (20,20))
-
-for i in features_to_show:
-    var = 'var_'+str(i)
-    signal = X_test[var].values
-    logits = preds_test[:,i]
-    func = interp1d(signal, logits)
-    space = np.linspace(signal.min(), signal.max(), 4000)
-    activations = func(space)
-    activations_smooth = gaussian_filter(activations, 10)
-    
-    func_smooth = interp1d(space, activations_smooth)
-    logits_smooth = func_smooth(signal)
-    plt.subplot(5,4,i+1)
-    plt.plot(space, activations)
-    plt.plot(space, activations_smooth)
+
+def plot_predictions():
+    from santander import smoothing
+    import matplotlib.pyplot as plt 
+
+    plt.figure(figsize = (20,20))
+
+    for j, i in enumerate([i for i in features_to_show if i < len(features)]):
+        signal = store.column('raw', i, 'test')
+        logits = preds_test[:,i]
+        space, activations = smoothing.get_grid(signal, logits, n_points_smooth)
+        activations_smooth = smoothing.smooth(activations, sigma_smooth)
+        plt.subplot(5,4,j+1)
+        plt.plot(space, activations)
+        plt.plot(space, activations_smooth)
+    plt.savefig(plot_path)
+    plt.close()
+    print(f'Saved the tree predictions of features_to_show to {plot_path}')
 
 # CNN
 # The CNN model is the main reason for our high placement as we hit a wall using solely trees and couldn't improve upon 0.922 LB. At some point while playing around with the trees I noticed two things:
@@ -382,27 +754,31 @@ for i in features_to_show:
 # I choose the architecure in a way which would ensure feature independence up until the last dense layer. In order to minimize overfitting and utilize the similarity of patterns across different var_x I used convolutional layers. The convolutions are performed across different var_x and at any point the filters only have a single var and their respective features in their field of view. Batch normalization is a great regularizer here and very crucial for the success of the model. The model has a total of 2.8K trainable parameters which is sufficiently low to prevent overfitting. I verified this by splitting train data into train / test with use_experimental = True at the top of the kernel and using test AUC as a gauge. The final prediction is the average of the 7 CNNs trained on every fold.
 
 # Training
-import keras
-
 n_splits = 7
 num_preds = 5
 epochs = 60
 learning_rate_init = 0.02
 batch_size = 4000
-
-num_features = len(features)
-
-def get_features(preds, df):
-    list_features = [preds, df[features].values, df[features_count].values, df[features_deviation], df[features_density]]
-    list_indices = []
-    for i in range(num_features):
-        indices = np.arange(num_preds)*num_features + i
-        list_indices.append(indices)
-    indices = np.concatenate(list_indices)
-    feats = np.concatenate(list_features, axis=1)[:,indices]
-    return feats 
+# Number of worker processes for the CNN folds and the threads of each. The folds are independent, and a model this small can't keep many
+# threads busy, so several single-model fits side by side use the cores much better. The workers are forked before the first model is
+# built (TensorFlow can't be used in a forked child once it is initialized in the parent) and read the features from the store like the
+# tree workers. Either way the fold weights are collected and all datasets are predicted with a single fused forward pass of all folds.
+# threads_nn = None splits the cores evenly between the workers (computed when the CNN stage runs, so it follows n_jobs_nn).
+n_jobs_nn = 1
+threads_nn = None
+
+def get_features(dataset, preds=None):
+    from santander.batches import StoreSource
+    # [pred, raw, count, deviation, density] of every var interleaved. Nothing is copied here, the returned source gathers the float32 rows
+    # of a batch from the store when the CNN asks for them, so only a few batches are in memory at any time. preds replaces the pred family
+    # (used for the in-fold train predictions which are not part of the store).
+    indices = np.stack([store.get_columns(family) for family in ['pred', 'raw', 'count', 'deviation', 'density']], axis=1).ravel()
+    replace = None if preds is None else (np.arange(0, len(indices), num_preds), preds)
+    return StoreSource(store, indices, dataset, replace=replace)
 
 def get_model_3():
+    import keras
+    num_features = len(features)
     inp = keras.layers.Input((num_features*num_preds,))
     x = keras.layers.Reshape((num_features*num_preds,1))(inp)
     x = keras.layers.Conv1D(32,num_preds,strides=num_preds, activation='elu')(x)
@@ -427,82 +803,221 @@ def lr_scheduler(epoch):
     else:
         return learning_rate_init * 0.1
 
-def train_NN(features_oof, features_test, features_train, features_fake):
-    
-    folds = StratifiedKFold(n_splits=n_splits)
-
-    preds_nn_oof = np.zeros(features_oof.shape[0])
-    preds_nn_test = np.zeros(features_test.shape[0])
-    preds_nn_fake = np.zeros(features_fake.shape[0])
-
-    for trn_idx, val_idx in folds.split(features_oof, target_train):
-        features_oof_tr = features_oof[trn_idx, :]
+def get_source(features):
+    from santander.batches import ArraySource
+    return ArraySource(features) if isinstance(features, np.ndarray) else features
+
+def predict_NN(model, features):
+    # (n_rows, n_splits) predictions of the fused fold models
+    from santander.batches import FeatureSequence
+    return model.predict(FeatureSequence(get_source(features), batch_size=2000))
+
+def set_threads_NN(threads):
+    # Runs in the CNN workers before TensorFlow is initialized
+    for name in ['OMP_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS']:
+        os.environ[name] = str(threads)
+
+def get_optimizer(lr):
+    # Adam with the time decay of keras 2. keras 3 has no decay argument anymore, it only lowers the learning rate by about 3% over the 60
+    # epochs, so it is left out there.
+    import keras
+    if int(keras.__version__.split('.')[0]) >= 3:
+        return keras.optimizers.Adam(learning_rate=lr)
+    return keras.optimizers.Adam(learning_rate=lr, decay=0.00001)
+
+def train_fold_NN(args):
+    # Trains fold k on the global features_oof and returns the weights and the profiler records, runs in the worker processes if n_jobs_nn > 1
+    import keras
+    from santander.batches import FeatureSequence
+    k, trn_idx, val_idx = args
+    profiler_fold = profiling.Profiler(enabled=profiler.enabled, trace_allocations=profiler.trace_allocations)
+    target_oof_tr = target_train.values[trn_idx]
+    target_oof_val = target_train.values[val_idx]
+
+    if refit_path:
+        # Fine-tuning on the new rows of the fold with the learning rate of the last epochs
+        model = keras.models.load_model(scoring.get_cnn_path(refit_path, k), compile=False)
+        trn_idx = trn_idx[trn_idx >= n_rows_previous['train']]
+        val_idx = val_idx[val_idx >= n_rows_previous['train']]
         target_oof_tr = target_train.values[trn_idx]
-        features_oof_val = features_oof[val_idx, :]
         target_oof_val = target_train.values[val_idx]
-
-        optimizer = keras.optimizers.Adam(lr = learning_rate_init, decay = 0.00001)
+        if len(trn_idx) == 0 or len(val_idx) == 0:
+            return model.get_weights(), profiler_fold.records
+        optimizer = get_optimizer(lr_scheduler(epochs))
+        callbacks = []
+        epochs_fold = refit_epochs
+    else:
+        optimizer = get_optimizer(learning_rate_init)
         model = get_model_3()
         callbacks = []
         callbacks.append(keras.callbacks.LearningRateScheduler(lr_scheduler))
-        model.compile(optimizer=optimizer, loss='binary_crossentropy', metrics=['accuracy'])
-        model.fit(features_oof_tr, target_oof_tr, validation_data=(features_oof_val, target_oof_val), epochs=epochs, verbose=2, batch_size=batch_size, callbacks=callbacks)
+        epochs_fold = epochs
+    model.compile(optimizer=optimizer, loss='binary_crossentropy', metrics=['accuracy'])
+    # The sequence shuffles the rows itself and has to be read in order for the prefetching
+    sequence_tr = FeatureSequence(get_source(features_oof), trn_idx, target_oof_tr, batch_size=batch_size, shuffle=True, seed=k)
+    sequence_val = FeatureSequence(get_source(features_oof), val_idx, target_oof_val, batch_size=batch_size)
+    with profiler_fold.stage('fit', fold=k):
+        model.fit(sequence_tr, validation_data=sequence_val, epochs=epochs_fold, verbose=2, shuffle=False, callbacks=callbacks)
+    return model.get_weights(), profiler_fold.records
+
+def train_NN(features_oof, features_test, features_train, features_fake, pool=None):
+    # features_* are sources of batches (see get_features) or arrays
+    from sklearn.model_selection import StratifiedKFold
+    from sklearn.metrics import roc_auc_score
+    
+    folds = StratifiedKFold(n_splits=n_splits)
+    jobs = [(k, trn_idx, val_idx) for k, (trn_idx, val_idx) in enumerate(split_folds(folds, target_train.values, 'cnn', save=True))]
+    results = pool.imap(train_fold_NN, jobs) if pool is not None else map(train_fold_NN, jobs)
+    models = []
+    for k, (weights, records) in enumerate(results):
+        profiler.extend(records)
+        model = get_model_3()
+        model.set_weights(weights)
+        if model_path:
+            scoring.save_cnn(model_path, k, model)
+        models.append(model)
+    if model_path:
+        scoring.save_cnn_kernel(model_path, models)
+
+    with profiler.stage('predict'):
+        model = scoring.get_fused_model(models)
+        preds_nn_oof = predict_NN(model, features_oof)
+        preds_nn_test = predict_NN(model, features_test)
+        preds_nn_fake = predict_NN(model, features_fake)
+
+    for k in range(n_splits):
+        print(roc_auc_score(target_train, preds_nn_oof[:,:k+1].mean(axis=1)))
+        if use_experimental:
+            print(roc_auc_score(target_test, preds_nn_test[:,:k+1].mean(axis=1)))
+    if use_experimental:
+        print(roc_auc_score(target_test, preds_test.mean(axis=1)))
 
-        preds_nn_oof += model.predict(features_oof, batch_size=2000)[:,0]
-        preds_nn_test += model.predict(features_test, batch_size=2000)[:,0]
-        preds_nn_fake += model.predict(features_fake, batch_size=2000)[:,0]
+    return preds_nn_oof.mean(axis=1), preds_nn_test.mean(axis=1), preds_nn_fake.mean(axis=1)
 
-        print(roc_auc_score(target_train, preds_nn_oof))
-        if use_experimental:
-            print(roc_auc_score(target_test, preds_nn_test))
-            print(roc_auc_score(target_test, preds_test.mean(axis=1)))
-
-    preds_nn_oof /= n_splits
-    preds_nn_test /= n_splits
-    preds_nn_fake /= n_splits
-    return preds_nn_oof, preds_nn_test, preds_nn_fake
-
-
-features_oof = get_features(preds_oof, X_train)
-features_test = get_features(preds_test, X_test)
-if not use_experimental:
-    del X_test
-features_train = get_features(preds_train, X_train)
-if not use_experimental:
-    del X_train
-features_fake = get_features(preds_fake, X_fake)
-if not use_experimental:
-    del X_fake
-    del preds_oof
-    del preds_fake
-    del preds_train
-    del preds_test
-
-print(get_model_3().summary())
-    
-preds_nn_oof, preds_nn_test, preds_nn_fake = train_NN(features_oof, features_test, features_train, features_fake)
+def run_cnn():
+    # The features are sources over the store, preds_* stay referenced by it, there is nothing to delete here anymore
+    global features_oof, features_test, features_train, features_fake, preds_nn_oof, preds_nn_test, preds_nn_fake
+    from sklearn.metrics import roc_auc_score
+    with profiler.stage('features'):
+        features_oof = get_features('train')
+        features_test = get_features('test')
+        features_train = get_features('train', preds_train)
+        features_fake = get_features('fake')
 
-print(roc_auc_score(target_train, preds_nn_oof))
-if use_experimental:
-    print('test AUC: ', roc_auc_score(target_test, preds_nn_test))
+    # Forked here, before get_model_3 initializes TensorFlow in this process
+    threads = threads_nn if threads_nn is not None else max(1, os.cpu_count() // n_jobs_nn)
+    pool_nn = Pool(n_jobs_nn, initializer=set_threads_NN, initargs=(threads,)) if n_jobs_nn > 1 else None
+
+    print(get_model_3().summary())
+        
+    with profiler.stage('train_NN'):
+        preds_nn_oof, preds_nn_test, preds_nn_fake = train_NN(features_oof, features_test, features_train, features_fake, pool=pool_nn)
+    if pool_nn is not None:
+        pool_nn.close()
+        pool_nn.join()
+
+    print(roc_auc_score(target_train, preds_nn_oof))
+    if use_experimental:
+        print('test AUC: ', roc_auc_score(target_test, preds_nn_test))
+    save_metrics('cnn', {'oof_auc': metrics.auc(target_train.values, preds_nn_oof), 'oof_auc_new': get_auc_new(target_train.values, preds_nn_oof)})
 
 # Generating submission
-preds_oof_final = preds_nn_oof
-preds_test_final = preds_nn_test
-preds_fake_final = preds_nn_fake
-
-print('oof  : ', roc_auc_score(target_train, preds_oof_final))
-if use_experimental:
-    print('test : ', roc_auc_score(target_test, preds_test_final))
-    print('train: ', roc_auc_score(target_fake, preds_fake_final))
-
-if not use_experimental:
-    sub = pd.DataFrame({"ID_code": test_df.ID_code.values})
-    predictions_all = np.zeros(test_df.shape[0])
-    predictions_all[indices_real] = preds_test_final
-    predictions_all[indices_fake] = preds_fake_final
-    sub["target"] = predictions_all
-    sub.to_csv("submission.csv", index=False)
-    print(sub.head(20))
+def submit():
+    import pandas as pd
+    from sklearn.metrics import roc_auc_score
+    preds_oof_final = preds_nn_oof
+    preds_test_final = preds_nn_test
+    preds_fake_final = preds_nn_fake
+
+    print('oof  : ', roc_auc_score(target_train, preds_oof_final))
+    if use_experimental:
+        print('test : ', roc_auc_score(target_test, preds_test_final))
+        print('train: ', roc_auc_score(target_fake, preds_fake_final))
+
+    if not use_experimental:
+        sub = pd.DataFrame({"ID_code": test.ID_code})
+        predictions_all = np.zeros(len(test))
+        predictions_all[indices_real] = preds_test_final
+        predictions_all[indices_fake] = preds_fake_final
+        sub["target"] = predictions_all
+        sub.to_csv("submission.csv", index=False)
+        print(sub.head(20))
+
+# Pipeline
+# Every stage works on the globals set by the stages before it (the store, targets and predictions), the worker pools are forked from this
+# process and see the same globals. train runs all stages up to --until, score only imports santander.scoring and scores new rows with a
+# saved model directory (python LightGBM_CNN_solution.py score model test.csv submission.csv, see santander/scoring.py for its options).
+stages = [('load', load_data), ('count', get_count), ('standardize', get_standardized), ('trees', run_trees), ('smooth', smooth_predictions),
+          ('cnn', run_cnn), ('submit', submit)]
+
+def get_profile_meta():
+    meta = {'n_jobs_count': n_jobs_count, 'n_jobs_trees': n_jobs_trees, 'n_jobs_nn': n_jobs_nn, 'store_dtype': np.dtype(store_dtype).name,
+            'smooth_preds': smooth_preds, 'report_smoothing': report_smoothing}
+    if 'store' in globals():
+        meta.update({'rows_' + name: store.n_rows(name) for name in ['train', 'test', 'fake']}, n_vars=len(features))
+    return meta
+
+def get_partial_path(path):
+    return path + '.partial'
+
+def publish_model(path_partial, path):
+    # Moves the finished model directory into place, the previous one is only removed once the new one is there
+    path_old = path + '.old'
+    shutil.rmtree(path_old, ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, path_old)
+    os.replace(path_partial, path)
+    shutil.rmtree(path_old, ignore_errors=True)
+
+def run(until='submit'):
+    global model_path
+    path = model_path
+    if path:
+        model_path = get_partial_path(path)
+        shutil.rmtree(model_path, ignore_errors=True)
+    try:
+        for name, stage in stages:
+            with profiler.stage(name):
+                stage()
+            if profile_path:
+                profiler.save(profile_path, **get_profile_meta())
+            if name == 'trees' and plot:
+                plot_predictions()
+            if name == until:
+                break
+        if path and name == 'submit':
+            publish_model(model_path, path)
+        elif path:
+            print(f'Stopped after {name}, the model is left in {model_path}')
+    finally:
+        model_path = path
+
+def main(argv=None):
+    global plot, plot_path, profile_path, smooth_preds, report_smoothing
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['score']:
+        from santander import scoring
+        return scoring.main(argv[1:])
+    parser = argparse.ArgumentParser(description='Train the LightGBM + CNN pipeline, or score new rows with a trained model directory (score -h)')
+    parser.add_argument('command', nargs='?', choices=['train'], default='train')
+    parser.add_argument('--until', choices=[name for name, stage in stages], default='submit', help='last stage to run')
+    parser.add_argument('--plot', nargs='?', const=plot_path, default=None, metavar='PATH',
+                        help='plot the tree predictions of features_to_show after the trees stage and save the figure (default: %(const)s)')
+    parser.add_argument('--smooth', action='store_true', help='replace the tree predictions with the smoothed ones for the CNN and scoring')
+    parser.add_argument('--report-smoothing', action='store_true', help='report the oof AUC with smoothed tree predictions without applying them')
+    parser.add_argument('--profile', default=profile_path, help='JSON file for the stage timings and memory (default: %(default)s)')
+    parser.add_argument('--trace-allocations', action='store_true', help='also record the peak numpy/Python heap of every stage')
+    args = parser.parse_args(argv)
+    if args.plot:
+        plot = True
+        plot_path = args.plot
+    smooth_preds = smooth_preds or args.smooth
+    report_smoothing = report_smoothing or args.report_smoothing
+    profile_path = args.profile
+    profiler.trace_allocations = profiler.trace_allocations or args.trace_allocations
+    run(args.until)
+
+if __name__ == '__main__':
+    main()
 
 # https://www.kaggle.com/code/nawidsayed/lightgbm-and-cnn-3rd-place-solution
@@ -0,0 +1 @@
+# Building blocks of the LightGBM + CNN solution that can be used outside of the training script (LightGBM_CNN_solution.py).
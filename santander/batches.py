@@ -0,0 +1,97 @@
+# CNN batches
+# Keras sequence over rows of a feature source, the batches are gathered on demand so the full feature matrix never has to be in memory.
+# A source is anything with len() and take(rows) returning the (len(rows), n_features) feature matrix of these rows: ArraySource wraps an
+# in-memory array, StoreSource gathers the given columns of a FeatureStore (which may be memory-mapped).
+# The next prefetch batches are gathered on a background thread while the model works on the current one, the sequence has to be read in
+# order for this (so it shuffles the rows itself, fit has to be called with shuffle=False).
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import keras
+
+
+class ArraySource:
+
+    def __init__(self, values):
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def take(self, rows):
+        return self.values[rows]
+
+
+class StoreSource:
+
+    # replace is an optional (positions, values) pair, the features at the given positions are replaced by the rows of values (n_rows, len(positions))
+
+    def __init__(self, store, columns, datasets, dtype=np.float32, replace=None):
+        self.store = store
+        self.columns = columns
+        self.datasets = datasets
+        self.dtype = dtype
+        self.replace = replace
+
+    def __len__(self):
+        return self.store.n_rows(self.datasets)
+
+    def take(self, rows):
+        x = self.store.take(self.columns, self.datasets, rows, dtype=self.dtype)
+        if self.replace is not None:
+            positions, values = self.replace
+            x[:,positions] = values[rows]
+        return x
+
+
+class FeatureSequence(keras.utils.Sequence):
+
+    def __init__(self, source, idx=None, y=None, batch_size=4000, shuffle=False, seed=0, prefetch=2):
+        super().__init__()
+        self.source = source
+        self.idx = np.arange(len(source)) if idx is None else np.asarray(idx)
+        self.y = y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.random_state = np.random.RandomState(seed)
+        self.order = np.arange(len(self.idx))
+        self.prefetch = prefetch
+        self.executor = None
+        self.pending = {}
+        if shuffle:
+            self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(len(self.idx) / self.batch_size))
+
+    def get_positions(self, b):
+        positions = self.order[b*self.batch_size:(b+1)*self.batch_size]
+        # Sorted rows read the (possibly memory-mapped) columns front to back
+        return np.sort(positions) if self.shuffle else positions
+
+    def load(self, positions):
+        x = self.source.take(self.idx[positions])
+        if self.y is None:
+            return x
+        return x, self.y[positions]
+
+    def __getitem__(self, b):
+        future = self.pending.pop(b, None)
+        batch = future.result() if future is not None else self.load(self.get_positions(b))
+        if self.prefetch:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=1)
+            for b_next in range(b + 1, min(b + 1 + self.prefetch, len(self))):
+                if b_next not in self.pending:
+                    # The positions are taken here, so the background thread never sees a reshuffled order
+                    self.pending[b_next] = self.executor.submit(self.load, self.get_positions(b_next))
+        return batch
+
+    def on_epoch_end(self):
+        # Prefetched batches belong to the order of the last epoch
+        for future in self.pending.values():
+            future.cancel()
+        self.pending = {}
+        if self.shuffle:
+            self.order = self.random_state.permutation(len(self.idx))
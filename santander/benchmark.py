@@ -0,0 +1,156 @@
+# Benchmark
+# Runs the pipeline on synthetic Santander-shaped data and writes the stage profile (santander/profiling.py) with the rows/s of every stage
+# to a JSON file, so throughput and memory can be compared across versions. The data has the layout of the competition files: train.csv
+# with ID_code, target and var_0 .. var_{n-1}, test.csv without target and the fake / public / private index files. Values are rounded to 4
+# decimals like the real ones and shifted a little for target = 1, so the trees and the CNN have something to learn. The files are
+# generated once per (rows, vars, seed) and reused, the csv cache and the model directory are rebuilt on every run so load and every
+# later stage always do the full work.
+# With --parity the pipeline runs a second time with a float64 feature store and the out-of-fold AUCs of both runs (metrics.json) are
+# reported side by side, which checks that the compact float32 representation doesn't cost accuracy. The trees are seeded and comparable
+# directly, the CNN weights are initialized randomly so its AUC only matches up to the run to run noise.
+#
+# Usage (from the repository root): python -m santander.benchmark [--rows 200000] [--vars 200] [--until submit] [--parity] [--output benchmark.json]
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import subprocess
+import importlib.metadata
+import numpy as np
+from santander import profiling
+
+packages = ['numpy', 'pandas', 'scipy', 'scikit-learn', 'lightgbm', 'keras', 'tensorflow']
+
+def make_data(path, n_rows, n_vars, seed=0, chunk_size=100000):
+    # Writes train.csv / test.csv with n_rows rows each and the index files (half of the test rows are fake), once
+    import pandas as pd
+    done_path = os.path.join(path, 'done')
+    if os.path.exists(done_path):
+        return
+    os.makedirs(path, exist_ok=True)
+    random_state = np.random.RandomState(seed)
+    shift = random_state.uniform(-0.2, 0.2, n_vars)
+    scale = random_state.uniform(1, 10, n_vars)
+    columns = ['var_' + str(i) for i in range(n_vars)]
+    for name in ['train', 'test']:
+        for start in range(0, n_rows, chunk_size):
+            n = min(chunk_size, n_rows - start)
+            target = (random_state.rand(n) < 0.1).astype(np.int8)
+            values = (random_state.randn(n, n_vars) + target[:,None] * shift) * scale
+            df = pd.DataFrame(values.round(4), columns=columns)
+            if name == 'train':
+                df.insert(0, 'target', target)
+            df.insert(0, 'ID_code', [f'{name}_{i}' for i in range(start, start + n)])
+            df.to_csv(os.path.join(path, name + '.csv'), index=False, mode='w' if start == 0 else 'a', header=start == 0)
+    indices = random_state.permutation(n_rows)
+    n_fake = n_rows // 2
+    np.save(os.path.join(path, 'synthetic_samples_indexes.npy'), np.sort(indices[:n_fake]))
+    np.save(os.path.join(path, 'public_LB.npy'), np.sort(indices[n_fake:n_fake + (n_rows - n_fake) // 2]))
+    np.save(os.path.join(path, 'private_LB.npy'), np.sort(indices[n_fake + (n_rows - n_fake) // 2:]))
+    open(done_path, 'w').close()
+
+def get_versions():
+    versions = {}
+    for package in packages:
+        try:
+            versions[package] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            pass
+    return versions
+
+def get_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_throughput(summary, n_rows):
+    # Rows of train + test + fake per second for every top level stage
+    return {name: n_rows / entry['seconds'] for name, entry in summary.items() if '/' not in name and entry['seconds'] > 0}
+
+def run_pipeline(pipeline, run_path, args, dtype=np.float32):
+    # Runs the pipeline in run_path with a fresh profiler and returns the metrics.json of the run
+    shutil.rmtree(run_path, ignore_errors=True)
+    pipeline.cache_path = os.path.join(run_path, 'cache')
+    pipeline.model_path = os.path.join(run_path, 'model')
+    pipeline.store_dtype = dtype
+    pipeline.profiler = profiling.Profiler(trace_allocations=args.trace_allocations)
+
+    # The submission is written to the working directory
+    cwd = os.getcwd()
+    os.makedirs(run_path, exist_ok=True)
+    try:
+        os.chdir(run_path)
+        pipeline.run(args.until)
+    finally:
+        os.chdir(cwd)
+    # Runs stopped before submit leave the model in the partial directory
+    metrics_path = os.path.join(pipeline.model_path, 'metrics.json')
+    if not os.path.exists(metrics_path):
+        metrics_path = os.path.join(pipeline.get_partial_path(pipeline.model_path), 'metrics.json')
+    if not os.path.exists(metrics_path):
+        return {}
+    with open(metrics_path) as f:
+        return json.load(f)
+
+def get_parity(metrics_compact, metrics_reference):
+    # oof AUC of every stage in the float32 and the float64 run
+    return {name: {'float32': metrics_compact[name]['oof_auc'], 'float64': metrics_reference[name]['oof_auc'],
+                   'change': metrics_compact[name]['oof_auc'] - metrics_reference[name]['oof_auc']}
+            for name in metrics_reference if name in metrics_compact}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the pipeline on synthetic Santander-shaped data and write the stage profile as JSON')
+    parser.add_argument('--rows', type=int, default=200000, help='rows of train and of test')
+    parser.add_argument('--vars', type=int, default=200, help='number of var_* columns (at most 200, the parameter tables have 200 entries)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--until', default='submit', help='last stage to run')
+    parser.add_argument('--epochs', type=int, default=2, help='CNN epochs')
+    parser.add_argument('--n-jobs-trees', type=int, default=1)
+    parser.add_argument('--n-jobs-nn', type=int, default=1)
+    parser.add_argument('--trace-allocations', action='store_true')
+    parser.add_argument('--parity', action='store_true', help='also run with a float64 feature store and compare the AUCs')
+    parser.add_argument('--work-dir', default='benchmark')
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args(argv)
+    if args.vars > 200:
+        parser.error('--vars must be at most 200')
+
+    data_path = os.path.abspath(os.path.join(args.work_dir, 'data', f'rows_{args.rows}_vars_{args.vars}_seed_{args.seed}'))
+    make_data(data_path, args.rows, args.vars, seed=args.seed)
+    run_path = os.path.abspath(os.path.join(args.work_dir, 'run'))
+
+    sys.path.insert(0, os.getcwd())
+    import LightGBM_CNN_solution as pipeline
+    pipeline.data_path = data_path + os.sep
+    pipeline.indices_path = data_path + os.sep
+    pipeline.tree_cache_path = None
+    pipeline.profile_path = None
+    pipeline.epochs = args.epochs
+    pipeline.n_jobs_trees = args.n_jobs_trees
+    pipeline.n_jobs_nn = args.n_jobs_nn
+
+    parity = None
+    if args.parity:
+        metrics_reference = run_pipeline(pipeline, os.path.abspath(os.path.join(args.work_dir, 'run_float64')), args, dtype=np.float64)
+    metrics = run_pipeline(pipeline, run_path, args)
+    if args.parity:
+        parity = get_parity(metrics, metrics_reference)
+
+    meta = pipeline.get_profile_meta()
+    n_rows = meta['rows_train'] + meta['rows_test'] + meta['rows_fake']
+    pipeline.profiler.save(args.output, **meta, rows=args.rows, vars=args.vars, seed=args.seed, until=args.until, epochs=args.epochs,
+                           revision=get_revision(), versions=get_versions(), cpu_count=os.cpu_count(),
+                           throughput=get_throughput(pipeline.profiler.summary(), n_rows), parity=parity)
+    with open(args.output) as f:
+        report = json.load(f)
+    for name, rows_per_second in report['meta']['throughput'].items():
+        entry = report['summary'][name]
+        print('{:<12} {:>8.2f} s - {:>12.0f} rows/s - peak RSS {:>8.1f} MB'.format(name, entry['seconds'], rows_per_second, entry['peak_rss'] / 1e6))
+    for name, entry in (parity or {}).items():
+        print('parity {:<5} oof AUC float32 {:.6f} - float64 {:.6f} ({:+.6f})'.format(name, entry['float32'], entry['float64'], entry['change']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# Content-addressed result cache
+# Results are stored under the hash of everything they were computed from (input arrays, parameters, seeds, ...), so a rerun finds the
+# results of unchanged work and anything that changed gets a new key. Entries are pickles written atomically, an interrupted run never
+# leaves a half written entry behind. Loading an entry refreshes its mtime and evict removes the least recently used entries until the cache
+# fits into max_bytes.
+
+import os
+import json
+import pickle
+import hashlib
+import numpy as np
+
+def get_key(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part)
+            h.update(str((part.dtype.str, part.shape)).encode())
+            h.update(part.data)
+        else:
+            h.update(json.dumps(part, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+def get_path(path, key):
+    return os.path.join(path, key[:2], key + '.pkl')
+
+def load(path, key):
+    # None if there is no entry for key
+    try:
+        with open(get_path(path, key), 'rb') as f:
+            value = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    os.utime(get_path(path, key))
+    return value
+
+def save(path, key, value):
+    path_entry = get_path(path, key)
+    os.makedirs(os.path.dirname(path_entry), exist_ok=True)
+    path_tmp = f'{path_entry}.{os.getpid()}.tmp'
+    with open(path_tmp, 'wb') as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path_tmp, path_entry)
+
+def evict(path, max_bytes):
+    # Removes the least recently saved / loaded entries until the remaining ones take at most max_bytes
+    entries = []
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            if name.endswith('.pkl'):
+                stat = os.stat(os.path.join(root, name))
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+    total = 0
+    for mtime, size, path_entry in sorted(entries, reverse=True):
+        total += size
+        if total > max_bytes:
+            os.remove(path_entry)
@@ -0,0 +1,135 @@
+# Data loading
+# The csv files are parsed once, in chunks, into a float32 columnar cache (one Fortran ordered values.npy, so every column is contiguous,
+# plus target.npy and ID_code.npy). Later runs memory-map the cache instead of parsing the csv again, the cache is rebuilt when the csv
+# changes (size / mtime). Subsets of rows (train / test, real / fake) are Tables that share the memory-mapped arrays and only hold an index
+# array, the rows are gathered once when they are copied into an array (e.g. the feature store).
+
+import os
+import json
+import numpy as np
+
+chunksize = 100000
+
+def count_rows(path):
+    n_lines = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            n_lines += block.count(b'\n')
+            last = block[-1:]
+    # Header line, and the last line might not end with a newline
+    return n_lines - 1 + (last != b'\n')
+
+def get_source_info(csv_path):
+    stat = os.stat(csv_path)
+    return {'source': os.path.abspath(csv_path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+def build_cache(csv_path, cache_path, chunksize=chunksize):
+    # pandas is only needed to parse the csv, loading an existing cache doesn't import it
+    import pandas as pd
+    os.makedirs(cache_path, exist_ok=True)
+    header = list(pd.read_csv(csv_path, nrows=0).columns)
+    columns = [c for c in header if c not in ['ID_code', 'target']]
+    n_rows = count_rows(csv_path)
+
+    values = np.lib.format.open_memmap(os.path.join(cache_path, 'values.npy'), mode='w+', dtype=np.float32, shape=(n_rows, len(columns)), fortran_order=True)
+    target = None
+    if 'target' in header:
+        target = np.lib.format.open_memmap(os.path.join(cache_path, 'target.npy'), mode='w+', dtype=np.int8, shape=(n_rows,))
+    list_ids = []
+    start = 0
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize, dtype={c: np.float32 for c in columns}):
+        end = start + len(chunk)
+        values[start:end] = chunk[columns].values
+        if target is not None:
+            target[start:end] = chunk['target'].values
+        if 'ID_code' in header:
+            list_ids.append(chunk['ID_code'].values.astype('S'))
+        start = end
+    if start != n_rows:
+        raise ValueError(f'{csv_path}: expected {n_rows} rows but parsed {start}')
+    values.flush()
+    if target is not None:
+        target.flush()
+    if list_ids:
+        np.save(os.path.join(cache_path, 'ID_code.npy'), np.concatenate(list_ids))
+
+    # meta.json is written last, an interrupted build is never mistaken for a valid cache
+    with open(os.path.join(cache_path, 'meta.json'), 'w') as f:
+        json.dump(dict(get_source_info(csv_path), columns=columns, n_rows=n_rows), f)
+
+def load(csv_path, cache_path=None, chunksize=chunksize):
+    # Returns a Table backed by the cache, the cache is built first if it is missing or outdated
+    if cache_path is None:
+        cache_path = os.path.splitext(csv_path)[0] + '_cache'
+    meta_path = os.path.join(cache_path, 'meta.json')
+    meta = None
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+    if meta is None or any(meta[key] != value for key, value in get_source_info(csv_path).items()):
+        build_cache(csv_path, cache_path, chunksize=chunksize)
+    return Table.load(cache_path)
+
+
+class Table:
+
+    def __init__(self, columns, values, target=None, ID_code=None, indices=None):
+        self.columns = list(columns)
+        self.values_all = values
+        self.target_all = target
+        self.ID_code_all = ID_code
+        self.indices = indices
+
+    @classmethod
+    def load(cls, cache_path):
+        with open(os.path.join(cache_path, 'meta.json')) as f:
+            meta = json.load(f)
+        values = np.load(os.path.join(cache_path, 'values.npy'), mmap_mode='r')
+        target = None
+        if os.path.exists(os.path.join(cache_path, 'target.npy')):
+            target = np.load(os.path.join(cache_path, 'target.npy'), mmap_mode='r')
+        ID_code = None
+        if os.path.exists(os.path.join(cache_path, 'ID_code.npy')):
+            ID_code = np.load(os.path.join(cache_path, 'ID_code.npy'), mmap_mode='r')
+        return cls(meta['columns'], values, target=target, ID_code=ID_code)
+
+    def __len__(self):
+        return self.values_all.shape[0] if self.indices is None else len(self.indices)
+
+    @property
+    def shape(self):
+        return (len(self), len(self.columns))
+
+    def view(self, indices):
+        # Rows of this table, no data is copied
+        indices = np.asarray(indices)
+        if self.indices is not None:
+            indices = self.indices[indices]
+        return Table(self.columns, self.values_all, target=self.target_all, ID_code=self.ID_code_all, indices=indices)
+
+    def take(self, array):
+        return array if self.indices is None else array[self.indices]
+
+    def column(self, name):
+        return self.take(self.values_all[:,self.columns.index(name)])
+
+    @property
+    def target(self):
+        if self.target_all is None:
+            return np.zeros(len(self), dtype=np.int8)
+        return self.take(self.target_all)
+
+    @property
+    def ID_code(self):
+        return self.take(self.ID_code_all).astype(str)
+
+    def get_values(self, out=None, dtype=np.float32):
+        if out is None:
+            out = np.empty((len(self), len(self.columns)), dtype=dtype, order='F')
+        for j in range(len(self.columns)):
+            out[:,j] = self.take(self.values_all[:,j])
+        return out
+
+    def index(self):
+        return np.arange(len(self)) if self.indices is None else self.indices
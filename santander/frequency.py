@@ -0,0 +1,244 @@
+# Counts, Density, Deviation
+# Every var_x is rounded to 4 decimals and counted over the concatenated train + test data. The density is the count histogram smoothed with a
+# gaussian whose sigma depends on the length of the histogram, the deviation is counts/density. The histograms are computed once per column
+# (FrequencyTables.fit) and can then be applied to any number of datasets (FrequencyTables.transform). Columns are processed in chunks on a
+# thread pool, numpy releases the GIL for the heavy parts (rounding, gathers).
+# The tables can be saved as a directory of .npy files and memory-mapped back (FrequencyTables.load), so scoring new rows only needs the
+# tables and not the training data. FrequencyTables.update adds the counts of new rows.
+
+import os
+import json
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+sigma_fac = 0.001
+sigma_base = 4
+scale = 10000
+
+eps = 0.00000001
+
+def to_int(values):
+    # Always round in float64, so float32 inputs end up in the same bins as the original csv values
+    return (np.asarray(values, dtype=np.float64) * scale).round().astype(np.int64)
+
+def get_sigma(n_bins):
+    # Geometric mean of twice sigma_base and a sigma_scaled which is scaled to the length of array
+    sigma_scaled = n_bins*sigma_fac
+    return np.power(sigma_base * sigma_base * sigma_scaled, 1/3)
+
+def count(values):
+    X_var_int = to_int(values)
+    lo = X_var_int.min()
+    X_var_int -= lo
+    return lo, np.bincount(X_var_int)
+
+def smooth(counts):
+    # Only fitting smooths, scoring with loaded tables doesn't need scipy
+    import scipy.ndimage
+    counts_all = counts.astype(float)
+    sigma = get_sigma(counts_all.shape[0])
+    return scipy.ndimage.gaussian_filter1d(counts_all, sigma), sigma
+
+def merge_counts(lo_a, counts_a, lo_b, counts_b):
+    # Sum of two histograms which start at the rounded values lo_a and lo_b
+    lo = min(lo_a, lo_b)
+    hi = max(lo_a + len(counts_a), lo_b + len(counts_b))
+    counts = np.zeros(hi - lo, dtype=np.int64)
+    counts[lo_a-lo:lo_a-lo+len(counts_a)] += counts_a
+    counts[lo_b-lo:lo_b-lo+len(counts_b)] += counts_b
+    return lo, counts
+
+def get_count_dtype(max_count):
+    # Smallest unsigned type for the histograms, a var_x value is rarely seen more than a few hundred times
+    return np.uint16 if max_count < 2**16 else np.uint32
+
+def get_values(X, columns=None):
+    # Accepts a DataFrame with the var_x columns (in any order and with additional columns) or a plain array
+    if hasattr(X, 'columns'):
+        columns = columns if columns is not None else [c for c in X.columns if c not in ['ID_code', 'target']]
+        return X[columns].values, columns
+    return np.asarray(X), columns
+
+def map_chunks(func, n_columns, n_jobs):
+    chunks = [chunk for chunk in np.array_split(np.arange(n_columns), max(1, min(n_jobs, n_columns))) if len(chunk)]
+    if n_jobs <= 1:
+        return [func(chunk) for chunk in chunks]
+    with ThreadPoolExecutor(n_jobs) as executor:
+        return list(executor.map(func, chunks))
+
+
+class FrequencyTables:
+    # The histograms of all columns are stored back to back in flat arrays, the bins of column i are at offsets[i]:offsets[i+1] and bin 0
+    # corresponds to the rounded value lo[i]. Counts are stored as uint16 (uint32 if a bin exceeds 65535), the smoothed counts as float64 so
+    # that density and deviation are exactly the values of the original loop with dtype=np.float64.
+
+    def __init__(self, lo, offsets, counts, counts_smooth, sigmas, columns=None, n_jobs=1):
+        self.lo = lo
+        self.offsets = offsets
+        self.counts = counts
+        self.counts_smooth = counts_smooth
+        self.sigmas = sigmas
+        self.columns = list(columns) if columns is not None else [f'var_{i}' for i in range(len(lo))]
+        self.n_jobs = n_jobs
+
+    @property
+    def n_columns(self):
+        return len(self.lo)
+
+    @classmethod
+    def from_counts(cls, lo, list_counts, columns=None, n_jobs=1):
+        def smooth_columns(cols):
+            return [smooth(list_counts[i]) for i in cols]
+
+        list_smooth = [table for chunk in map_chunks(smooth_columns, len(list_counts), n_jobs) for table in chunk]
+        offsets = np.concatenate([[0], np.cumsum([len(counts) for counts in list_counts])]).astype(np.int64)
+        counts = np.concatenate(list_counts)
+        counts = counts.astype(get_count_dtype(counts.max() if len(counts) else 0))
+        counts_smooth = np.concatenate([table[0] for table in list_smooth])
+        sigmas = np.array([table[1] for table in list_smooth])
+        return cls(np.asarray(lo, dtype=np.int64), offsets, counts, counts_smooth, sigmas, columns=columns, n_jobs=n_jobs)
+
+    @classmethod
+    def fit(cls, X, columns=None, n_jobs=1):
+        X, columns = get_values(X, columns)
+
+        def count_columns(cols):
+            return [count(X[:,i]) for i in cols]
+
+        tables = [table for chunk in map_chunks(count_columns, X.shape[1], n_jobs) for table in chunk]
+        return cls.from_counts([table[0] for table in tables], [table[1] for table in tables], columns=columns, n_jobs=n_jobs)
+
+    @classmethod
+    def fit_stream(cls, shards, columns=None, n_jobs=1):
+        # Same as fit on all rows, but the rows come in shards (e.g. row blocks of a memory-mapped file) and only one shard is in memory at
+        # a time. The histograms are summed over the shards and smoothed once at the end.
+        tables = None
+        for X in shards:
+            X, columns = get_values(X, columns)
+
+            def count_columns(cols):
+                return [count(X[:,i]) for i in cols]
+
+            tables_shard = [table for chunk in map_chunks(count_columns, X.shape[1], n_jobs) for table in chunk]
+            if tables is None:
+                tables = tables_shard
+            else:
+                tables = [merge_counts(*table, *table_shard) for table, table_shard in zip(tables, tables_shard)]
+        return cls.from_counts([table[0] for table in tables], [table[1] for table in tables], columns=columns, n_jobs=n_jobs)
+
+    def get_counts(self, i):
+        return self.counts[self.offsets[i]:self.offsets[i+1]]
+
+    def update(self, X):
+        # Adds the counts of new rows, the result is the same as fitting on all rows at once. Columns whose range grows are padded, the
+        # smoothing is recomputed on the (much smaller than the data) histograms.
+        X, _ = get_values(X, self.columns)
+        if X.shape[0] == 0:
+            return self
+        list_lo = []
+        list_counts = []
+        for i in range(self.n_columns):
+            lo, counts = merge_counts(self.lo[i], self.get_counts(i).astype(np.int64), *count(X[:,i]))
+            list_lo.append(lo)
+            list_counts.append(counts)
+        tables = FrequencyTables.from_counts(list_lo, list_counts, columns=self.columns, n_jobs=self.n_jobs)
+        self.lo, self.offsets, self.counts, self.counts_smooth, self.sigmas = tables.lo, tables.offsets, tables.counts, tables.counts_smooth, tables.sigmas
+        return self
+
+    def allocate(self, n_rows, dtype=np.float32):
+        # count, density and deviation of each column are contiguous in memory, out[0] has shape (n_rows, n_columns)
+        return np.empty((3, self.n_columns, n_rows), dtype=dtype).transpose(0, 2, 1)
+
+    def transform(self, X, out=None, dtype=np.float32, shard_size=None):
+        # Returns count, density and deviation with shape (n_rows, n_columns) each. Values outside of the fitted range get count, density and
+        # deviation 0. With dtype=np.float64 the result is identical to the original get_count loop, with np.float32 the gathers and the
+        # division run in float32 (the deviation may differ from the rounded float64 one by a few ulps). With shard_size the rows of every column
+        # are processed in blocks of shard_size rows, which bounds the temporary memory for X / out that are memory-mapped.
+        X, _ = get_values(X, self.columns)
+        if out is None:
+            out = self.allocate(X.shape[0], dtype)
+        dtype = out[0].dtype
+        shard_size = shard_size or max(X.shape[0], 1)
+
+        def transform_columns(cols):
+            for i in cols:
+                for start in range(0, X.shape[0], shard_size):
+                    rows = slice(start, start + shard_size)
+                    indices = to_int(X[rows,i]) - self.lo[i]
+                    n_bins = self.offsets[i+1] - self.offsets[i]
+                    valid = (indices >= 0) & (indices < n_bins)
+                    all_valid = valid.all()
+                    if not all_valid:
+                        indices[~valid] = 0
+                    indices += self.offsets[i]
+                    counts = self.counts[indices].astype(dtype)
+                    density = self.counts_smooth[indices].astype(dtype, copy=False)
+                    for out_feature, values in zip(out, [counts, density, counts / (density+eps)]):
+                        out_feature[rows,i] = values
+                        if not all_valid:
+                            out_feature[rows,i][~valid] = 0
+
+        map_chunks(transform_columns, X.shape[1], self.n_jobs)
+        return out[0], out[1], out[2]
+
+    def lookup(self, df, dtype=np.float32):
+        # Maps the raw var_x columns of a DataFrame to a DataFrame with the var_x_count, var_x_density and var_x_deviation columns
+        import pandas as pd
+        features_count, features_density, features_deviation = self.transform(df, dtype=dtype)
+        list_df = []
+        for suffix, values in zip(['_count', '_density', '_deviation'], [features_count, features_density, features_deviation]):
+            list_df.append(pd.DataFrame(values, columns=[var+suffix for var in self.columns], index=df.index))
+        return pd.concat(list_df, axis=1)
+
+    def save(self, path):
+        # One .npy file per table, so load can memory-map them
+        os.makedirs(path, exist_ok=True)
+        for name in table_names:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'columns': self.columns, 'scale': scale, 'sigma_fac': sigma_fac, 'sigma_base': sigma_base}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r', n_jobs=1):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        tables = [np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in table_names]
+        return cls(*tables, columns=meta['columns'], n_jobs=n_jobs)
+
+table_names = ['lo', 'offsets', 'counts', 'counts_smooth', 'sigmas']
+
+
+def get_count_reference(X_all, X):
+    # The original single threaded float64 loop, only used to verify FrequencyTables
+    import scipy.ndimage
+    X_all = np.asarray(X_all)
+    X = np.asarray(X)
+    features_count = np.zeros(X.shape)
+    features_density = np.zeros(X.shape)
+    features_deviation = np.zeros(X.shape)
+    for i in range(X_all.shape[1]):
+        X_all_var_int = (X_all[:,i] * scale).round().astype(int)
+        X_var_int = (X[:,i] * scale).round().astype(int)
+        lo = X_all_var_int.min()
+        X_all_var_int -= lo
+        X_var_int -= lo
+        hi = X_all_var_int.max()+1
+        counts_all = np.bincount(X_all_var_int, minlength=hi).astype(float)
+        sigma = get_sigma(counts_all.shape[0])
+        counts_all_smooth = scipy.ndimage.gaussian_filter1d(counts_all, sigma)
+        deviation = counts_all / (counts_all_smooth+eps)
+        features_count[:,i] = counts_all[X_var_int]
+        features_density[:,i] = counts_all_smooth[X_var_int]
+        features_deviation[:,i] = deviation[X_var_int]
+    return features_count, features_density, features_deviation
+
+def check_tables(tables, X_all, X, rtol=0, atol=0, dtype=np.float32):
+    # Compares FrequencyTables against the original loop, rtol=atol=0 with dtype=np.float64 checks for bit for bit equality. In float32 the
+    # deviation is divided in float32 from the rounded density, so it is only compared up to a few float32 ulps.
+    features_new = tables.transform(X, dtype=dtype)
+    features_ref = get_count_reference(X_all, X)
+    for name, new, ref in zip(['count', 'density', 'deviation'], features_new, features_ref):
+        ref = ref.astype(dtype).astype(np.float64) if rtol == 0 and atol == 0 else ref
+        rtol_name = max(rtol, 4 * float(np.finfo(dtype).eps)) if name == 'deviation' and np.dtype(dtype) != np.float64 else rtol
+        if not np.allclose(new, ref, rtol=rtol_name, atol=atol):
+            raise AssertionError(f'{name} differs by up to {np.abs(new - ref).max()}')
@@ -0,0 +1,114 @@
+# NumPy inference kernel for the CNN folds (get_model_3)
+# The model only has 2.8K parameters, loading keras and a backend costs far more than running it. export reads the weights of the trained
+# fold models into a CNNKernel which needs nothing but NumPy:
+# - The first Conv1D has kernel size = strides = num_preds, so it is one (num_preds, 32) matmul applied to every var of the (rows, n_vars,
+#   num_preds) view of the input (the 2D (rows*n_vars, num_preds) reshape of it, which BLAS handles much better than np.einsum).
+# - The pointwise Conv1D layers are matmuls over the channels. Every BatchNormalization follows an elu, so it can't be folded backwards,
+#   instead its inference affine (x - mean) / sqrt(var + eps) * gamma + beta is folded into the weights of the next layer.
+# - AveragePooling1D over the flattened (var, channel) axis and the last BatchNormalization are linear, so both are folded into the Dense
+#   weights, which leaves a (n_vars, channels) weight per fold and a single dot product per row.
+# predict returns the (n_rows, n_folds) sigmoid outputs like scoring.get_fused_model, rows are processed in chunks that fit into the cache.
+
+import numpy as np
+
+def get_layers(model, name):
+    return [layer for layer in model.layers if type(layer).__name__ == name]
+
+def get_affine(bn):
+    gamma, beta, mean, var = bn.get_weights()
+    scale = gamma / np.sqrt(var + bn.epsilon)
+    return scale, beta - mean * scale
+
+def export_model(model):
+    convs = get_layers(model, 'Conv1D')
+    bns = get_layers(model, 'BatchNormalization')
+    denses = get_layers(model, 'Dense')
+    pools = get_layers(model, 'AveragePooling1D')
+    if len(bns) != len(convs) or len(denses) != 1 or len(pools) != 1 or convs[0].kernel_size[0] != convs[0].strides[0]:
+        raise ValueError('Only models with the layout of get_model_3 can be exported')
+    if any(conv.kernel_size[0] != 1 for conv in convs[1:]):
+        raise ValueError('Only pointwise convolutions after the first layer can be exported')
+
+    # Conv1D kernels have the shape (kernel_size, in_channels, out_channels)
+    weights = []
+    kernel, bias = convs[0].get_weights()
+    weights.append((kernel[:,0,:], bias))
+    for bn, conv in zip(bns[:-1], convs[1:]):
+        scale, shift = get_affine(bn)
+        kernel, bias = conv.get_weights()
+        kernel = kernel[0]
+        weights.append((scale[:,None] * kernel, shift @ kernel + bias))
+
+    # Pooling over the flattened (var, channel) axis and the last BatchNormalization, folded into the Dense weights
+    pool_size = pools[0].pool_size[0]
+    scale, shift = get_affine(bns[-1])
+    kernel, bias = denses[0].get_weights()
+    kernel = kernel[:,0]
+    kernel_dense = np.repeat(scale * kernel, pool_size) / pool_size
+    bias_dense = shift @ kernel + bias[0]
+    n_channels = weights[-1][0].shape[1]
+    return weights, kernel_dense.reshape(-1, n_channels), bias_dense
+
+def export(models):
+    exported = [export_model(model) for model in models]
+    weights = [(np.stack([w[l][0] for w, _, _ in exported]), np.stack([w[l][1] for w, _, _ in exported])) for l in range(len(exported[0][0]))]
+    return CNNKernel(weights, np.stack([e[1] for e in exported]), np.array([e[2] for e in exported]))
+
+def elu(x):
+    # In place, x becomes max(x, 0) + expm1(min(x, 0))
+    negative = np.minimum(x, 0)
+    np.expm1(negative, out=negative)
+    np.maximum(x, 0, out=x)
+    x += negative
+    return x
+
+
+class CNNKernel:
+
+    def __init__(self, weights, kernel_dense, bias_dense, dtype=np.float32, chunk_size=256):
+        # weights: list of (kernel (n_folds, in, out), bias (n_folds, out)) per conv layer, kernel_dense: (n_folds, n_vars, channels)
+        self.weights = [(kernel.astype(dtype), bias.astype(dtype)) for kernel, bias in weights]
+        self.kernel_dense = kernel_dense.astype(dtype)
+        self.bias_dense = bias_dense.astype(dtype)
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.n_folds, self.n_vars, _ = self.kernel_dense.shape
+        self.num_preds = self.weights[0][0].shape[1]
+
+    def predict_chunk(self, x, k):
+        h = x.reshape(-1, self.num_preds)
+        for kernel, bias in self.weights:
+            h = h @ kernel[k]
+            h += bias[k]
+            elu(h)
+        return h.reshape(len(x), -1) @ self.kernel_dense[k].ravel() + self.bias_dense[k]
+
+    def predict(self, X, out=None):
+        # X: (n_rows, n_vars*num_preds) interleaved as in get_features, returns the (n_rows, n_folds) fold predictions
+        X = X.reshape(len(X), -1)
+        if out is None:
+            out = np.empty((len(X), self.n_folds), dtype=self.dtype)
+        for start in range(0, len(X), self.chunk_size):
+            x = np.ascontiguousarray(X[start:start+self.chunk_size], dtype=self.dtype)
+            for k in range(self.n_folds):
+                out[start:start+len(x),k] = self.predict_chunk(x, k)
+        # Sigmoid
+        np.negative(out, out=out)
+        np.exp(out, out=out)
+        out += 1
+        np.reciprocal(out, out=out)
+        return out
+
+    def save(self, path):
+        arrays = {'kernel_dense': self.kernel_dense, 'bias_dense': self.bias_dense}
+        for l, (kernel, bias) in enumerate(self.weights):
+            arrays[f'kernel_{l}'] = kernel
+            arrays[f'bias_{l}'] = bias
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        arrays = np.load(path)
+        n_layers = len([name for name in arrays.files if name.startswith('kernel_') and name != 'kernel_dense'])
+        weights = [(arrays[f'kernel_{l}'], arrays[f'bias_{l}']) for l in range(n_layers)]
+        return cls(weights, arrays['kernel_dense'], arrays['bias_dense'])
@@ -0,0 +1,114 @@
+# Lookup-table predictor for the per-variable trees
+# Every per-variable booster only splits on its 1-2 input columns (var_x and var_x_count), so the whole ensemble is piecewise constant on
+# the grid spanned by its split thresholds. compile_booster evaluates the booster once per grid cell, after that a prediction is one
+# searchsorted per input column and a gather. As the cell values come from the booster itself and LightGBM sends x <= threshold to the left
+# (which is exactly the cell np.searchsorted(thresholds, x, side='left') finds), the predictions are identical to booster.predict.
+# compile_ensemble merges the tables of several boosters (e.g. the folds of one variable) into one table on the union of their thresholds.
+# Inputs must not contain NaN, the training data never does.
+
+import os
+import numpy as np
+
+from santander.frequency import map_chunks
+
+def get_thresholds(booster):
+    n_features = booster.num_feature()
+    thresholds = [set() for d in range(n_features)]
+
+    def walk(node):
+        if 'split_feature' not in node:
+            return
+        if node['decision_type'] != '<=' or node.get('missing_type', 'None') == 'Zero':
+            raise ValueError('Only numerical splits without zero as missing can be compiled, got {} / {}'.format(node['decision_type'], node.get('missing_type')))
+        thresholds[node['split_feature']].add(node['threshold'])
+        walk(node['left_child'])
+        walk(node['right_child'])
+
+    for tree in booster.dump_model()['tree_info']:
+        walk(tree['tree_structure'])
+    return [np.array(sorted(t), dtype=np.float64) for t in thresholds]
+
+def get_grid(thresholds):
+    # One point per cell: the upper threshold of every cell (cell j is t[j-1] < x <= t[j]) and a point above the largest threshold
+    if len(thresholds) == 0:
+        return np.zeros(1)
+    return np.append(thresholds, np.nextafter(thresholds[-1], np.inf))
+
+def get_grid_points(thresholds):
+    grids = np.meshgrid(*[get_grid(t) for t in thresholds], indexing='ij')
+    return np.stack([grid.ravel() for grid in grids], axis=1)
+
+
+class TreeTable:
+
+    def __init__(self, thresholds, values):
+        self.thresholds = thresholds
+        self.values = values.reshape([len(t)+1 for t in thresholds])
+
+    def lookup(self, *columns):
+        cells = tuple(np.searchsorted(t, column, side='left') for t, column in zip(self.thresholds, columns))
+        return self.values[cells]
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        return self.lookup(*[X[:,d] for d in range(X.shape[1])])
+
+def compile_booster(booster):
+    thresholds = get_thresholds(booster)
+    return TreeTable(thresholds, booster.predict(get_grid_points(thresholds)))
+
+def compile_ensemble(tables, func):
+    # func gets the list of predictions of all tables on the grid points and returns the combined prediction
+    thresholds = [np.unique(np.concatenate([table.thresholds[d] for table in tables])) for d in range(len(tables[0].thresholds))]
+    points = get_grid_points(thresholds)
+    return TreeTable(thresholds, func([table.predict(points) for table in tables]))
+
+
+class LookupPredictor:
+    # Tables of all variables, predict(raw, count) returns a (n_rows, n_vars) matrix where column i is table i applied to column i of
+    # every input. save/load store all tables in a few flat .npy files.
+
+    def __init__(self, tables, n_jobs=1):
+        self.tables = tables
+        self.n_jobs = n_jobs
+
+    def predict(self, *inputs, out=None, dtype=np.float64):
+        # float32 inputs are searched as they are, np.searchsorted compares them exactly against the float64 thresholds
+        inputs = [np.asarray(inp) for inp in inputs]
+        if out is None:
+            out = np.empty(inputs[0].shape, dtype=dtype)
+
+        def predict_columns(cols):
+            for i in cols:
+                out[:,i] = self.tables[i].lookup(*[inp[:,i] for inp in inputs])
+
+        map_chunks(predict_columns, len(self.tables), self.n_jobs)
+        return out
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        n_inputs = len(self.tables[0].thresholds)
+        for d in range(n_inputs):
+            list_thresholds = [table.thresholds[d] for table in self.tables]
+            np.save(os.path.join(path, f'thresholds_{d}.npy'), np.concatenate(list_thresholds))
+            np.save(os.path.join(path, f'offsets_{d}.npy'), np.cumsum([0] + [len(t) for t in list_thresholds]))
+        np.save(os.path.join(path, 'values.npy'), np.concatenate([table.values.ravel() for table in self.tables]))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r', n_jobs=1):
+        list_thresholds = []
+        list_offsets = []
+        d = 0
+        while os.path.exists(os.path.join(path, f'thresholds_{d}.npy')):
+            list_thresholds.append(np.load(os.path.join(path, f'thresholds_{d}.npy'), mmap_mode=mmap_mode))
+            list_offsets.append(np.load(os.path.join(path, f'offsets_{d}.npy')))
+            d += 1
+        values = np.load(os.path.join(path, 'values.npy'), mmap_mode=mmap_mode)
+        tables = []
+        start = 0
+        for i in range(len(list_offsets[0])-1):
+            thresholds = [t[offsets[i]:offsets[i+1]] for t, offsets in zip(list_thresholds, list_offsets)]
+            size = int(np.prod([len(t)+1 for t in thresholds]))
+            tables.append(TreeTable(thresholds, values[start:start+size]))
+            start += size
+        return cls(tables, n_jobs=n_jobs)
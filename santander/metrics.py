@@ -0,0 +1,70 @@
+# Evaluation
+# Rank based AUC and log loss in plain numpy. CumulativeScore keeps the running sum of the per-variable predictions, so the cumulative
+# metrics after each variable cost O(n) for the sum instead of recomputing the mean over all previous columns, and it keeps the sort order of
+# the previous step: adding one more column only moves rows a little, and a stable sort (timsort) of an almost sorted array is close to
+# linear.
+
+import numpy as np
+
+eps = 1e-15
+
+def get_eps(p):
+    # 1 - 1e-15 rounds to 1 in float32, which would give log(0), so float32 predictions are clipped at its resolution
+    return max(eps, float(np.finfo(p.dtype).eps)) if np.issubdtype(p.dtype, np.floating) else eps
+
+def get_loss_sum(y, p):
+    p_eps = get_eps(p)
+    p = np.clip(p, p_eps, 1 - p_eps)
+    return -(y * np.log(p) + (1 - y) * np.log(1 - p)).sum()
+
+def log_loss(y, p):
+    y = np.asarray(y)
+    return get_loss_sum(y, np.asarray(p)) / len(y)
+
+def auc_sorted(scores, y):
+    # AUC of scores sorted in ascending order (Mann-Whitney U, ties get their average rank)
+    n = len(scores)
+    change = np.empty(n, dtype=bool)
+    change[0] = True
+    np.not_equal(scores[1:], scores[:-1], out=change[1:])
+    starts = np.flatnonzero(change)
+    ends = np.append(starts[1:], n)
+    ranks = ((starts + ends + 1) / 2)[np.cumsum(change) - 1]
+    n_pos = y.sum()
+    n_neg = n - n_pos
+    return (ranks[y == 1].sum() - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+
+def auc(y, p, order=None):
+    y = np.asarray(y)
+    p = np.asarray(p)
+    order = np.argsort(p, kind='stable') if order is None else order[np.argsort(p[order], kind='stable')]
+    return auc_sorted(p[order], y[order])
+
+
+class CumulativeScore:
+    # Running mean of prediction columns with AUC / log loss of the current mean
+
+    def __init__(self, y):
+        self.y = np.asarray(y)
+        self.sum = np.zeros(len(self.y))
+        self.n = 0
+        self.order = None
+
+    def add(self, column):
+        self.sum += column
+        self.n += 1
+
+    @property
+    def mean(self):
+        return self.sum / self.n
+
+    def auc(self):
+        # Dividing by n doesn't change the ranking, so the sum is sorted directly
+        if self.order is None:
+            self.order = np.argsort(self.sum, kind='stable')
+        else:
+            self.order = self.order[np.argsort(self.sum[self.order], kind='stable')]
+        return auc_sorted(self.sum[self.order], self.y[self.order])
+
+    def log_loss(self, transform=np.exp):
+        return log_loss(self.y, transform(self.mean))
@@ -0,0 +1,127 @@
+# Stage profiling
+# Profiler.stage(name) records the wall and CPU seconds of a block, the RSS after it and the peak RSS during it. Stages nest, a record's name is
+# the path of the open stages ('trees/fold/train') and extra keyword arguments (var=i, fold=k) are kept as tags of the record and of the
+# records of the stages nested in it, so summary() can sum per name and the records can still be split per var or fold. The peak RSS of a stage is measured by resetting the kernel's high water mark (/proc/self/clear_refs, Linux only) when it starts.
+# Elsewhere the peak is the process lifetime maximum from getrusage. With trace_allocations the peak of the Python/numpy heap
+# (tracemalloc) is recorded too. This is slow for the many small allocations of the tree stage, so it is off by default.
+# Worker processes profile into their own Profiler and send its records back with their results, see Profiler.extend.
+
+import os
+import sys
+import json
+import time
+import resource
+import tracemalloc
+from contextlib import contextmanager
+
+def read_status(key):
+    # Value of key in /proc/self/status in bytes, None where there is no /proc
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+def get_rss():
+    rss = read_status('VmRSS')
+    return rss if rss is not None else get_peak_rss()
+
+def get_peak_rss():
+    peak = read_status('VmHWM')
+    if peak is not None:
+        return peak
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+class Profiler:
+
+    def __init__(self, enabled=True, trace_allocations=False):
+        self.enabled = enabled
+        self.trace_allocations = trace_allocations
+        self.records = []
+        self.stack = []
+
+    def get_name(self, name):
+        return '/'.join([frame['name'] for frame in self.stack] + [name])
+
+    def update_peaks(self, frame):
+        frame['peak_rss'] = max(frame['peak_rss'], get_peak_rss())
+        if self.trace_allocations:
+            frame['peak_alloc'] = max(frame['peak_alloc'], tracemalloc.get_traced_memory()[1])
+
+    @contextmanager
+    def stage(self, name, **tags):
+        if not self.enabled:
+            yield
+            return
+        if self.trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        # The peaks of the enclosing stages up to here are kept before the high water marks are reset for this one
+        if self.stack:
+            self.update_peaks(self.stack[-1])
+        reset_peak_rss()
+        if self.trace_allocations:
+            tracemalloc.reset_peak()
+        frame = {'name': name, 'peak_rss': 0, 'peak_alloc': 0, 'tags': dict(self.stack[-1]['tags'] if self.stack else {}, **tags)}
+        time_start = time.perf_counter()
+        cpu_start = time.process_time()
+        self.stack.append(frame)
+        try:
+            yield
+        finally:
+            self.stack.pop()
+            self.update_peaks(frame)
+            record = {
+                'name': self.get_name(name),
+                'seconds': time.perf_counter() - time_start,
+                'cpu_seconds': time.process_time() - cpu_start,
+                'rss': get_rss(),
+                'peak_rss': frame['peak_rss'],
+            }
+            if self.trace_allocations:
+                record['peak_alloc'] = frame['peak_alloc']
+            record.update(frame['tags'])
+            self.records.append(record)
+            if self.stack:
+                parent = self.stack[-1]
+                parent['peak_rss'] = max(parent['peak_rss'], frame['peak_rss'])
+                parent['peak_alloc'] = max(parent['peak_alloc'], frame['peak_alloc'])
+
+    def extend(self, records, prefix=None, **tags):
+        # Adds the records of a worker Profiler, nested under prefix (the open stages if None)
+        prefix = '/'.join(frame['name'] for frame in self.stack) if prefix is None else prefix
+        for record in records:
+            record = dict(record, **tags)
+            if prefix:
+                record['name'] = prefix + '/' + record['name']
+            self.records.append(record)
+
+    def summary(self):
+        # Total seconds, number of records and largest peak RSS per stage name
+        summary = {}
+        for record in self.records:
+            entry = summary.setdefault(record['name'], {'seconds': 0, 'cpu_seconds': 0, 'count': 0, 'peak_rss': 0})
+            entry['seconds'] += record['seconds']
+            entry['cpu_seconds'] += record['cpu_seconds']
+            entry['count'] += 1
+            entry['peak_rss'] = max(entry['peak_rss'], record['peak_rss'])
+        return summary
+
+    def save(self, path, **meta):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        path_tmp = path + '.tmp'
+        with open(path_tmp, 'w') as f:
+            json.dump({'meta': meta, 'summary': self.summary(), 'records': self.records}, f, indent=1)
+        os.replace(path_tmp, path)
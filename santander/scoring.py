@@ -0,0 +1,232 @@
+# Batch scoring
+# Scores new rows with the trained pipeline: frequency tables -> StandardScaler -> 200 x n_folds per-variable trees -> sqrt transform ->
+# interleaved CNN input -> average of the CNN folds. The training script saves everything needed into a model directory:
+#
+#   model/meta.json                     features, n_folds, n_splits, rows of train.csv / test.csv the model was fit on, dtype of the features
+#   model/frequency_tables/             FrequencyTables.save
+#   model/scaler.npz                    mean_ and scale_ of the StandardScaler for [features, features_count]
+#   model/trees/var_{i}_fold_{k}.txt    LightGBM boosters of the best setting
+#   model/tree_means.npy                (n_vars, n_folds) mean prediction of every booster on the test set
+#   model/lut/                          the boosters and the sqrt transform compiled into one lookup table per variable (santander/lut.py)
+#   model/cnn/fold_{k}.h5               get_model_3 of every CNN fold
+#   model/cnn_kernel.npz                all CNN folds exported to a NumPy kernel (santander/kernel.py)
+#   model/folds/{var_i,cnn}.npy         fold of every train row, only read by the next incremental refit
+#   model/curves.npz                    smoothed tree predictions of every variable, only if the CNN was trained on them (santander/smoothing.py)
+#
+# During training the sqrt(p - mean + 0.1) transform subtracts the mean prediction over the whole dataset. A batch mean would make the
+# score of a row depend on the other rows in its batch, so scoring subtracts the mean of the test set predictions instead.
+#
+# With use_lut the 5 fold boosters of every variable, including the sqrt transform, are compiled into a single lookup table (santander/lut.py)
+# which gives the same values as predicting with the boosters. With use_kernel the CNN folds are evaluated by the NumPy kernel, which matches
+# the keras models up to float32 rounding.
+#
+# The features are computed in the dtype of the feature store the model was trained with (float32 by default): the raw values, the counts
+# and the scaler are rounded to it and standardized with the same two in place operations as get_standardized, so the trees see the exact
+# inputs they were trained on.
+#
+# If the model has smoothed prediction curves, the tree predictions are the curves evaluated at the standardized features and neither the
+# boosters nor the lookup tables are loaded.
+#
+# LightGBM and keras are only imported when the compiled lookup tables or the kernel are missing (or switched off), scoring a model directory
+# which has both only needs numpy and pandas (for reading and writing the batches, the training script imports this module without it).
+#
+# Usage: python -m santander.scoring model input.csv|input.parquet output.csv [--batch-size 100000]
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+from santander.frequency import FrequencyTables, map_chunks
+from santander import lut
+from santander import kernel
+from santander.smoothing import SmoothCurves
+
+def save_meta(path, features, n_folds, n_splits, n_rows=None, dtype=np.float64):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'features': list(features), 'n_folds': n_folds, 'n_splits': n_splits, 'n_rows': n_rows, 'dtype': np.dtype(dtype).name}, f)
+
+def get_frequency_tables_path(path):
+    return os.path.join(path, 'frequency_tables')
+
+def save_scaler(path, scaler):
+    os.makedirs(path, exist_ok=True)
+    np.savez(os.path.join(path, 'scaler.npz'), mean=scaler.mean_, scale=scaler.scale_)
+
+def get_tree_path(path, i, k):
+    return os.path.join(path, 'trees', f'var_{i}_fold_{k}.txt')
+
+def save_trees(path, i, model_strings):
+    os.makedirs(os.path.join(path, 'trees'), exist_ok=True)
+    for k, model_string in enumerate(model_strings):
+        with open(get_tree_path(path, i, k), 'w') as f:
+            f.write(model_string)
+
+def save_tree_means(path, tree_means):
+    np.save(os.path.join(path, 'tree_means.npy'), tree_means)
+
+def load_boosters(path, n_vars, n_folds):
+    import lightgbm as lgb
+    return [[lgb.Booster(model_file=get_tree_path(path, i, k)) for k in range(n_folds)] for i in range(n_vars)]
+
+def compile_trees(boosters, tree_means, n_jobs=1):
+    # One lookup table per variable for its fold boosters and the sqrt transform of their predictions
+    def compile_var(i):
+        def transform(predictions):
+            preds = np.zeros(len(predictions[0]))
+            for k, prediction in enumerate(predictions):
+                preds += np.sqrt(prediction - tree_means[i,k] + 0.1) / len(predictions)
+            return preds
+
+        return lut.compile_ensemble([lut.compile_booster(clf) for clf in boosters[i]], transform)
+
+    return lut.LookupPredictor([compile_var(i) for i in range(len(boosters))], n_jobs=n_jobs)
+
+def get_lut_path(path):
+    return os.path.join(path, 'lut')
+
+def save_lut(path, n_vars, n_folds):
+    # Needs the trees and tree means of path, after that Scorer doesn't have to load (or import) LightGBM anymore
+    tree_means = np.load(os.path.join(path, 'tree_means.npy'))
+    compile_trees(load_boosters(path, n_vars, n_folds), tree_means).save(get_lut_path(path))
+
+def get_cnn_path(path, k):
+    return os.path.join(path, 'cnn', f'fold_{k}.h5')
+
+def save_cnn(path, k, model):
+    os.makedirs(os.path.join(path, 'cnn'), exist_ok=True)
+    model.save(get_cnn_path(path, k))
+
+def get_kernel_path(path):
+    return os.path.join(path, 'cnn_kernel.npz')
+
+def save_cnn_kernel(path, models):
+    os.makedirs(path, exist_ok=True)
+    kernel.export(models).save(get_kernel_path(path))
+
+def get_curves_path(path):
+    return os.path.join(path, 'curves.npz')
+
+def get_fused_model(models):
+    # All fold models in one graph, a single forward pass returns the (n_rows, n_models) predictions of every fold
+    import keras
+    inp = keras.layers.Input(models[0].input_shape[1:])
+    return keras.Model(inputs=inp, outputs=keras.layers.Concatenate()([model(inp) for model in models]))
+
+
+class Scorer:
+
+    def __init__(self, path, n_jobs=1, batch_size_nn=20000, use_lut=True, use_kernel=True):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.features = meta['features']
+        self.dtype = np.dtype(meta.get('dtype', 'float64'))
+        self.n_folds = meta['n_folds']
+        self.n_jobs = n_jobs
+        self.batch_size_nn = batch_size_nn
+        self.tables = FrequencyTables.load(get_frequency_tables_path(path), n_jobs=n_jobs)
+        scaler = np.load(os.path.join(path, 'scaler.npz'))
+        n_vars = len(self.features)
+        self.mean = scaler['mean'].reshape(2, n_vars).astype(self.dtype)
+        self.scale = scaler['scale'].reshape(2, n_vars).astype(self.dtype)
+        self.tree_means = np.load(os.path.join(path, 'tree_means.npy'))
+        self.boosters = None
+        self.tree_predictor = None
+        self.curves = None
+        if os.path.exists(get_curves_path(path)):
+            self.curves = SmoothCurves.load(get_curves_path(path))
+        elif use_lut and os.path.exists(get_lut_path(path)):
+            self.tree_predictor = lut.LookupPredictor.load(get_lut_path(path), n_jobs=n_jobs)
+        else:
+            self.boosters = load_boosters(path, n_vars, self.n_folds)
+            if use_lut:
+                self.tree_predictor = compile_trees(self.boosters, self.tree_means, n_jobs=n_jobs)
+        self.kernel = None
+        self.model = None
+        if use_kernel and os.path.exists(get_kernel_path(path)):
+            self.kernel = kernel.CNNKernel.load(get_kernel_path(path))
+        else:
+            import keras
+            self.model = get_fused_model([keras.models.load_model(get_cnn_path(path, k)) for k in range(meta['n_splits'])])
+
+    def get_tree_preds(self, raw, count):
+        if self.curves is not None:
+            return self.curves.predict(raw)
+        if self.tree_predictor is not None:
+            return self.tree_predictor.predict(raw, count, dtype=self.dtype)
+        preds = np.zeros(raw.shape, dtype=self.dtype)
+
+        def predict_columns(cols):
+            for i in cols:
+                X_var = np.column_stack([raw[:,i], count[:,i]])
+                for k, clf in enumerate(self.boosters[i]):
+                    prediction = clf.predict(X_var, num_threads=1)
+                    preds[:,i] += np.sqrt(prediction - self.tree_means[i,k] + 0.1) / self.n_folds
+
+        map_chunks(predict_columns, raw.shape[1], self.n_jobs)
+        return preds
+
+    def get_features(self, df):
+        # CNN input with shape (n_rows, n_vars, 5), reshaped to (n_rows, n_vars*5) this is the interleave of get_features in the script
+        raw = df[self.features].values.astype(self.dtype)
+        features_count, features_density, features_deviation = self.tables.transform(raw, dtype=self.dtype)
+        raw -= self.mean[0]
+        raw /= self.scale[0]
+        count = features_count
+        count -= self.mean[1]
+        count /= self.scale[1]
+        feats = np.empty((len(df), len(self.features), 5), dtype=np.float32)
+        feats[:,:,0] = self.get_tree_preds(raw, count)
+        feats[:,:,1] = raw
+        feats[:,:,2] = count
+        feats[:,:,3] = features_deviation
+        feats[:,:,4] = features_density
+        return feats
+
+    def predict(self, df):
+        feats = self.get_features(df).reshape(len(df), -1)
+        if self.kernel is not None:
+            return self.kernel.predict(feats).mean(axis=1)
+        return self.model.predict(feats, batch_size=self.batch_size_nn, verbose=0).mean(axis=1)
+
+
+def read_batches(path, batch_size):
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+            yield batch.to_pandas()
+    else:
+        import pandas as pd
+        yield from pd.read_csv(path, chunksize=batch_size)
+
+def score_file(scorer, input_path, output_path, batch_size=100000):
+    import pandas as pd
+    n_rows = 0
+    time_start = time.time()
+    for b, df in enumerate(read_batches(input_path, batch_size)):
+        time_batch = time.time()
+        sub = pd.DataFrame({'ID_code': df['ID_code'].values, 'target': scorer.predict(df)})
+        sub.to_csv(output_path, index=False, mode='w' if b == 0 else 'a', header=b == 0)
+        n_rows += len(df)
+        print('batch {} - rows: {} - rows/s: {:<10.0f} - total rows/s: {:<10.0f}'.format(
+            b, len(df), len(df) / (time.time() - time_batch), n_rows / (time.time() - time_start)))
+    return n_rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Score csv or parquet batches with a trained LightGBM + CNN model directory')
+    parser.add_argument('model')
+    parser.add_argument('input')
+    parser.add_argument('output')
+    parser.add_argument('--batch-size', type=int, default=100000)
+    parser.add_argument('--n-jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--no-lut', action='store_true', help='predict with the LightGBM boosters instead of the compiled lookup tables')
+    parser.add_argument('--no-kernel', action='store_true', help='predict with the keras models instead of the NumPy CNN kernel')
+    args = parser.parse_args(argv)
+    scorer = Scorer(args.model, n_jobs=args.n_jobs, use_lut=not args.no_lut, use_kernel=not args.no_kernel)
+    score_file(scorer, args.input, args.output, batch_size=args.batch_size)
+
+if __name__ == '__main__':
+    sys.exit(main())
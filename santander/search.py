@@ -0,0 +1,37 @@
+# Per-variable hyperparameter search
+# Evaluates every combination of a parameter grid for a single variable with successive halving over the folds: all candidates are trained on
+# the first fold, only the best 1/prune_factor (by their log loss on the folds seen so far) continue to the next fold, and so on. The
+# candidates that survive all folds are ranked by their out-of-fold log loss. As the folds partition the rows the OOF log loss is the sum of
+# the per fold losses, so no OOF prediction vectors are kept per candidate. The training data is binned once per max_bin.
+
+import itertools
+import numpy as np
+import lightgbm as lgb
+
+from santander import lut
+from santander.metrics import get_loss_sum
+
+def search_var(X, y, list_folds, params, grid, prune_factor=2, num_boost_round=2000, early_stopping_rounds=10):
+    # grid: dict of parameter name -> list of values. Returns the index into every value list of the best candidate and its OOF log loss.
+    names = list(grid)
+    candidates = list(itertools.product(*[range(len(grid[name])) for name in names]))
+    loss_sum = {candidate: 0 for candidate in candidates}
+    n_rows = {candidate: 0 for candidate in candidates}
+    datasets = {}
+    for k, (trn_idx, val_idx) in enumerate(list_folds):
+        for candidate in candidates:
+            params_candidate = dict(params, **{name: grid[name][ind] for name, ind in zip(names, candidate)})
+            max_bin = params_candidate.get('max_bin', 255)
+            if max_bin not in datasets:
+                datasets[max_bin] = lgb.Dataset(X, label=y, params=params_candidate, free_raw_data=False).construct()
+            trn_data = datasets[max_bin].subset(trn_idx)
+            val_data = datasets[max_bin].subset(val_idx)
+            clf = lgb.train(params_candidate, trn_data, num_boost_round, valid_sets=[trn_data, val_data],
+                            callbacks=[lgb.early_stopping(early_stopping_rounds, verbose=False), lgb.log_evaluation(0)])
+            loss_sum[candidate] += get_loss_sum(y[val_idx], lut.compile_booster(clf).predict(X[val_idx]))
+            n_rows[candidate] += len(val_idx)
+        if k < len(list_folds) - 1:
+            candidates = sorted(candidates, key=lambda candidate: loss_sum[candidate] / n_rows[candidate])
+            candidates = candidates[:int(np.ceil(len(candidates) / prune_factor))]
+    best = min(candidates, key=lambda candidate: loss_sum[candidate])
+    return dict(zip(names, best)), loss_sum[best] / n_rows[best]
@@ -0,0 +1,76 @@
+# Smoothed tree predictions
+# The per-variable tree predictions are very noisy at the tails of the feature distributions. fit_curve smoothes the (sqrt transformed)
+# predictions of one booster: they are linearly interpolated over the standardized feature onto a grid of n_points equally spaced values
+# between its min and max, and smoothed with a gaussian of width sigma grid points (interp1d -> linspace -> gaussian_filter of the EDA
+# plots). Afterwards a prediction only depends on the feature value. A SmoothCurves holds one such curve per variable and evaluates all
+# variables at once in predict, one gather of the two neighbouring grid points and a linear interpolation between them. Values outside of
+# the fitted range get the value of the end point. The curves can be saved as one .npz file, applying them needs nothing but NumPy.
+
+import numpy as np
+
+n_points = 4000
+sigma = 10
+
+def get_grid(signal, logits, n_points=n_points):
+    # Linear interpolation of the predictions onto the grid, predictions of identical feature values are averaged first (interp1d picks
+    # one of them). NaN predictions (sqrt of a negative p - mean + 0.1) are left out.
+    signal = np.asarray(signal, dtype=np.float64)
+    space = np.linspace(signal.min(), signal.max(), n_points)
+    valid = np.isfinite(logits)
+    signal, logits = signal[valid], logits[valid]
+    values, inverse = np.unique(signal, return_inverse=True)
+    logits = np.bincount(inverse, weights=logits, minlength=len(values)) / np.bincount(inverse, minlength=len(values))
+    return space, np.interp(space, values, logits)
+
+def smooth(activations, sigma=sigma):
+    # Only fitting smooths, applying loaded curves doesn't need scipy
+    import scipy.ndimage
+    return scipy.ndimage.gaussian_filter1d(activations, sigma)
+
+def fit_curve(signal, logits, n_points=n_points, sigma=sigma):
+    # Smoothed predictions on the grid between signal.min() and signal.max()
+    space, activations = get_grid(signal, logits, n_points)
+    return smooth(activations, sigma)
+
+def interp(x, lo, hi, values):
+    # A single curve at the values x, same as SmoothCurves.predict for one variable
+    return np.interp(x, np.linspace(lo, hi, len(values)), values)
+
+
+class SmoothCurves:
+
+    def __init__(self, lo, hi, values, dtype=np.float32, chunk_size=4096):
+        # lo / hi: (n_vars,) range of the grid of every variable, values: (n_vars, n_points) smoothed predictions on the grid
+        self.lo = np.asarray(lo, dtype=np.float64)
+        self.hi = np.asarray(hi, dtype=np.float64)
+        self.values = np.ascontiguousarray(values, dtype=np.float64)
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.n_vars, self.n_points = self.values.shape
+        self.step = (self.hi - self.lo) / (self.n_points - 1)
+        # Constant features have a single grid value
+        self.step[self.step == 0] = 1
+        self.offsets = np.arange(self.n_vars) * self.n_points
+
+    def predict(self, X, out=None):
+        # X: (n_rows, n_vars) standardized features, returns the (n_rows, n_vars) smoothed predictions
+        if out is None:
+            out = np.empty(X.shape, dtype=self.dtype)
+        values = self.values.ravel()
+        for start in range(0, len(X), self.chunk_size):
+            rows = slice(start, start + self.chunk_size)
+            position = (np.asarray(X[rows], dtype=np.float64) - self.lo) / self.step
+            np.clip(position, 0, self.n_points - 1, out=position)
+            index = np.minimum(position.astype(np.int64), self.n_points - 2)
+            position -= index
+            index += self.offsets
+            out[rows] = values[index] + (values[index+1] - values[index]) * position
+        return out
+
+    def save(self, path):
+        np.savez(path, lo=self.lo, hi=self.hi, values=self.values)
+
+    @classmethod
+    def load(cls, path):
+        arrays = np.load(path)
+        return cls(arrays['lo'], arrays['hi'], arrays['values'])
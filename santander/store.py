@@ -0,0 +1,91 @@
+# Feature store
+# All features of all datasets live in one preallocated, Fortran ordered float32 matrix. Datasets (train / test / fake) are consecutive row
+# ranges and feature families (raw, count, density, deviation, tree predictions, ...) are consecutive column ranges, so every
+# (family, dataset) block is a numpy view the stages can write into in place. Only the rows / columns a consumer actually needs (e.g. the two
+# columns of one tree for one fold) are ever copied. All families have to be known when the store is created, adding a family means one more
+# block of columns in the same allocation and not another copy of the data.
+# With a path the matrix is a memory-mapped .npy file instead, for data that doesn't fit into memory. As every column is contiguous on disk, a
+# stage that works column by column (frequency tables, per-variable trees) only pages in the columns it needs.
+
+import os
+import numpy as np
+
+
+class FeatureStore:
+
+    def __init__(self, datasets, families, dtype=np.float32, path=None):
+        # datasets: list of (name, n_rows), families: list of (name, column names)
+        self.path = path
+        self.rows = {}
+        start = 0
+        for name, n_rows in datasets:
+            self.rows[name] = slice(start, start + n_rows)
+            start += n_rows
+        self.cols = {}
+        self.names = {}
+        col = 0
+        for name, names in families:
+            self.cols[name] = slice(col, col + len(names))
+            self.names[name] = list(names)
+            col += len(names)
+        self.values = self.empty('values', (start, col), dtype=dtype)
+
+    def empty(self, name, shape, dtype=np.float64):
+        # Zero initialized Fortran ordered array, memory-mapped next to the store if it has a path
+        if self.path is None:
+            return np.zeros(shape, dtype=dtype, order='F')
+        os.makedirs(self.path, exist_ok=True)
+        return np.lib.format.open_memmap(os.path.join(self.path, name + '.npy'), mode='w+', dtype=dtype, shape=shape, fortran_order=True)
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+    def get_slice(self, registry, keys):
+        # A single key or a list of keys that are adjacent in the registry (e.g. ['train', 'test'] or ['raw', 'count'])
+        if keys is None:
+            return slice(None)
+        if isinstance(keys, str):
+            return registry[keys]
+        slices = [registry[key] for key in keys]
+        for a, b in zip(slices[:-1], slices[1:]):
+            if a.stop != b.start:
+                raise ValueError(f'{keys} are not adjacent in the store')
+        return slice(slices[0].start, slices[-1].stop)
+
+    def get(self, families=None, datasets=None):
+        # View of the block, writing into it writes into the store
+        return self.values[self.get_slice(self.rows, datasets), self.get_slice(self.cols, families)]
+
+    def column(self, family, i, datasets=None):
+        return self.values[self.get_slice(self.rows, datasets), self.cols[family].start + i]
+
+    def n_rows(self, datasets):
+        s = self.get_slice(self.rows, datasets)
+        return s.stop - s.start
+
+    def get_columns(self, families):
+        # Global column indices of one family or a list of families
+        if isinstance(families, str):
+            families = [families]
+        return np.concatenate([np.arange(self.cols[family].start, self.cols[family].stop) for family in families])
+
+    def get_shards(self, datasets=None, shard_size=None):
+        # Row slices of shard_size rows covering the datasets, relative to the start of the datasets
+        n_rows = self.values.shape[0] if datasets is None else self.n_rows(datasets)
+        shard_size = shard_size or max(n_rows, 1)
+        return [slice(start, min(start + shard_size, n_rows)) for start in range(0, n_rows, shard_size)]
+
+    def take(self, columns, datasets=None, idx=None, out=None, dtype=None):
+        # Copy of the given global columns (and rows idx within the datasets), column by column so no intermediate copies are made
+        block = self.values[self.get_slice(self.rows, datasets)]
+        n_rows = block.shape[0] if idx is None else len(idx)
+        if out is None:
+            out = np.empty((n_rows, len(columns)), dtype=dtype or self.values.dtype)
+        for j, col in enumerate(columns):
+            out[:,j] = block[:,col] if idx is None else block[idx,col]
+        return out
@@ -0,0 +1,28 @@
+# FrequencyTables against the original get_count loop on synthetic data
+# The values are rounded to 3 decimals so that the histograms have repeated bins like the real var_x columns. The reference loop can only
+# look up rows of the fitted data.
+
+import numpy as np
+
+from santander.frequency import FrequencyTables, check_tables
+
+def get_data(n_rows=3000, n_vars=5, seed=0):
+    random_state = np.random.RandomState(seed)
+    return np.round(random_state.normal(size=(n_rows, n_vars)) * random_state.uniform(1, 10, n_vars), 3)
+
+def test_transform_matches_loop_float64():
+    X_all = get_data()
+    check_tables(FrequencyTables.fit(X_all), X_all, X_all[::3], rtol=0, atol=0, dtype=np.float64)
+
+def test_transform_matches_loop_float32():
+    X_all = get_data()
+    check_tables(FrequencyTables.fit(X_all, n_jobs=2), X_all, X_all[:500], dtype=np.float32)
+
+def test_update_matches_fit():
+    # The second part widens the range of every column, so update has to pad the histograms on both sides
+    X_all = np.concatenate([get_data(), get_data(1000, seed=1) * 2])
+    tables = FrequencyTables.fit(X_all[:3000]).update(X_all[3000:])
+    tables_all = FrequencyTables.fit(X_all)
+    for name in ['lo', 'offsets', 'counts', 'counts_smooth', 'sigmas']:
+        np.testing.assert_array_equal(getattr(tables, name), getattr(tables_all, name), err_msg=name)
+    assert tables.counts.dtype == tables_all.counts.dtype
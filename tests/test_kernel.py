@@ -0,0 +1,45 @@
+# NumPy CNN kernel against the fused keras model on synthetic data
+# The fold models are get_model_3 of the pipeline with random weights. Fresh BatchNormalization layers are the identity at inference, so
+# their statistics are randomized as well, otherwise folding them into the next layer would not be tested.
+
+import numpy as np
+import pytest
+
+from santander import kernel
+from santander import scoring
+
+keras = pytest.importorskip('keras')
+
+def get_models(n_models=3, n_vars=6, seed=0):
+    import LightGBM_CNN_solution as pipeline
+    pipeline.features = [f'var_{i}' for i in range(n_vars)]
+    random_state = np.random.RandomState(seed)
+    models = []
+    for k in range(n_models):
+        model = pipeline.get_model_3()
+        for layer in model.layers:
+            weights = layer.get_weights()
+            if type(layer).__name__ == 'BatchNormalization':
+                gamma, beta, mean, var = [random_state.uniform(0.5, 1.5, size=w.shape) for w in weights]
+                weights = [gamma, beta - 1, mean - 1, var]
+            else:
+                weights = [random_state.normal(size=w.shape) * 0.3 for w in weights]
+            layer.set_weights(weights)
+        models.append(model)
+    return models
+
+def test_export_matches_fused_model():
+    models = get_models()
+    X = np.random.RandomState(1).normal(size=(1000, models[0].input_shape[1])).astype(np.float32)
+    expected = scoring.get_fused_model(models).predict(X, batch_size=256, verbose=0)
+    predictions = kernel.export(models).predict(X)
+    assert predictions.shape == expected.shape == (len(X), len(models))
+    np.testing.assert_allclose(predictions, expected, rtol=1e-4, atol=1e-6)
+
+def test_save_load(tmp_path):
+    models = get_models(n_models=2)
+    X = np.random.RandomState(2).normal(size=(300, models[0].input_shape[1])).astype(np.float32)
+    cnn_kernel = kernel.export(models)
+    path = str(tmp_path / 'cnn_kernel.npz')
+    cnn_kernel.save(path)
+    np.testing.assert_array_equal(kernel.CNNKernel.load(path).predict(X), cnn_kernel.predict(X))
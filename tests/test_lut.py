@@ -0,0 +1,43 @@
+# Compiled lookup tables against booster.predict on synthetic data
+# The boosters are trained like the per-variable trees (var_x and var_x_count). Besides random rows the inputs contain every split
+# threshold and its neighbouring floats, where a wrong side of a split would show.
+
+import numpy as np
+import pytest
+
+from santander import lut
+
+lgb = pytest.importorskip('lightgbm')
+
+def get_booster(seed=0):
+    random_state = np.random.RandomState(seed)
+    X = np.stack([random_state.normal(size=2000), random_state.randint(1, 6, 2000)], axis=1)
+    y = (X[:,0] + 0.3 * X[:,1] + random_state.normal(size=2000) > 1).astype(int)
+    params = {'objective': 'binary', 'num_leaves': 4, 'learning_rate': 0.1, 'max_bin': 256, 'seed': seed, 'verbosity': -1}
+    return lgb.train(params, lgb.Dataset(X, y), num_boost_round=50)
+
+def get_inputs(thresholds, seed=0):
+    random_state = np.random.RandomState(seed)
+    columns = []
+    for t in thresholds:
+        edges = np.concatenate([t, np.nextafter(t, -np.inf), np.nextafter(t, np.inf)])
+        columns.append(np.concatenate([random_state.normal(size=1000) * 3, random_state.choice(edges, 1000)]))
+    return np.stack(columns, axis=1)
+
+def test_compile_booster_matches_predict():
+    booster = get_booster()
+    table = lut.compile_booster(booster)
+    X = get_inputs(table.thresholds)
+    np.testing.assert_array_equal(table.predict(X), booster.predict(X))
+
+def test_lookup_predictor_matches_predict(tmp_path):
+    # Two variables, saved and memory-mapped back like in the model directory
+    boosters = [get_booster(seed) for seed in range(2)]
+    tables = [lut.compile_booster(booster) for booster in boosters]
+    inputs = [get_inputs(table.thresholds, seed) for seed, table in enumerate(tables)]
+    raw = np.stack([X[:,0] for X in inputs], axis=1)
+    count = np.stack([X[:,1] for X in inputs], axis=1)
+    lut.LookupPredictor(tables).save(str(tmp_path))
+    predictor = lut.LookupPredictor.load(str(tmp_path), n_jobs=2)
+    expected = np.stack([booster.predict(X) for booster, X in zip(boosters, inputs)], axis=1)
+    np.testing.assert_array_equal(predictor.predict(raw, count), expected)